@@ -0,0 +1,207 @@
+"""
+This file is responsible to store games in a compact binary archive.
+
+Layout, all little-endian:
+
+    file header   magic, number of games, offset of the index
+    game          length of the tag block, number of moves,
+                  tag block ("name\\0value\\0" pairs, padded to even length),
+                  one uint16 per move: start | end << 6 | promotion << 12
+    ...
+    index         one uint64 file offset per game
+
+Moves keep only start, end and promotion (`code & MOVE_MASK`), the flags are
+recovered from the board when a game is replayed. The index gives any game in
+O(1), and the reader returns move codes as NumPy views of the memory-mapped
+file, so nothing is copied until a game is replayed.
+"""
+
+import mmap
+import os
+import struct
+import sys
+import numpy as np
+from chess_error import ChessError
+from move import MOVE_MASK
+import pgn
+
+MAGIC = b"CHGAME1\0"
+FILE_HEADER = struct.Struct("<8sQQ")  # magic, games, index offset
+GAME_HEADER = struct.Struct("<IH")  # tag block length, moves
+MOVE_DTYPE = np.dtype("<u2")
+
+
+def encode_tags(headers):
+    block = b"".join(
+        name.encode() + b"\0" + value.encode() + b"\0"
+        for name, value in headers.items()
+    )
+    return block + b"\0" * (len(block) & 1)  # keeps the moves 2-byte aligned
+
+
+def decode_tags(block):
+    fields = bytes(block).rstrip(b"\0").split(b"\0")
+    return {
+        name.decode(): value.decode("utf-8", "replace")
+        for name, value in zip(fields[::2], fields[1::2])
+    }
+
+
+class ArchiveWriter:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path + ".tmp", "wb")
+        self.file.write(FILE_HEADER.pack(MAGIC, 0, 0))
+        self.offsets = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:  # leave no half written archive behind
+            self.file.close()
+            os.remove(self.path + ".tmp")
+
+    def add(self, headers, moves):  # moves as Move objects or codes
+        codes = np.array(
+            [getattr(m, "code", m) & MOVE_MASK for m in moves],
+            dtype=MOVE_DTYPE,
+        )
+        if len(codes) > 0xFFFF:
+            raise ChessError(f"game of {len(codes)} half moves is too long")
+        tags = encode_tags(headers)
+        self.offsets.append(self.file.tell())
+        self.file.write(GAME_HEADER.pack(len(tags), len(codes)))
+        self.file.write(tags)
+        self.file.write(codes.tobytes())
+
+    def close(self):
+        index_offset = self.file.tell()
+        self.file.write(np.array(self.offsets, dtype="<u8").tobytes())
+        self.file.seek(0)
+        self.file.write(
+            FILE_HEADER.pack(MAGIC, len(self.offsets), index_offset)
+        )
+        self.file.close()
+        os.replace(self.path + ".tmp", self.path)
+
+
+class GameArchive:
+    def __init__(self, path):
+        self.offsets = None
+        self.file = open(path, "rb")
+        try:
+            self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty file
+            self.file.close()
+            raise ChessError(f"{path} is not a game archive")
+        magic, self.size, index_offset = FILE_HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or index_offset + 8 * self.size != len(self.mm):
+            self.close()
+            raise ChessError(f"{path} is not a game archive")
+        self.offsets = np.frombuffer(
+            self.mm, dtype="<u8", count=self.size, offset=index_offset
+        )
+
+    def __len__(self):
+        return self.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        # views handed out by raw_game may outlive the archive, the map is
+        # then left open for garbage collection to free once they are gone
+        self.offsets = None
+        try:
+            self.mm.close()
+        except BufferError:
+            pass
+        self.file.close()
+
+    def raw_game(self, i):
+        # (headers, move codes) of game i; the codes are a read-only view of
+        # the file, nothing is copied
+        if not -self.size <= i < self.size:
+            raise IndexError(f"game {i} out of range")
+        offset = int(self.offsets[i])
+        tags_size, n_moves = GAME_HEADER.unpack_from(self.mm, offset)
+        tags_start = offset + GAME_HEADER.size
+        headers = decode_tags(self.mm[tags_start : tags_start + tags_size])
+        codes = np.frombuffer(
+            self.mm,
+            dtype=MOVE_DTYPE,
+            count=n_moves,
+            offset=tags_start + tags_size,
+        )
+        return headers, codes
+
+    def game(self, i):  # game i with its moves replayed into Move objects
+        headers, codes = self.raw_game(i)
+        game = pgn.PGNGame(headers, [], int(self.offsets[i]))
+        g = game.start_board()
+        for code in codes.tolist():
+            m = g.find_move(code)
+            if m is None:
+                raise ChessError(f"game {i} has an illegal move {code:#06x}")
+            g.make_move(m, validate=False)
+            game.moves.append(m)
+        return game
+
+    def iter_raw(self):  # (headers, move codes) of every game, in order
+        for i in range(self.size):
+            yield self.raw_game(i)
+
+    def __iter__(self):
+        for i in range(self.size):
+            yield self.game(i)
+
+
+def pgn_to_archive(paths, out_path, skip_invalid=False):  # returns games
+    with ArchiveWriter(out_path) as writer:
+        for path in paths:
+            for game in pgn.read_games(path, skip_invalid=skip_invalid):
+                writer.add(game.headers, game.moves)
+        return len(writer.offsets)
+
+
+def archive_to_pgn(path, out_path):  # returns games
+    with GameArchive(path) as archive:
+        return pgn.write_games(archive, out_path)
+
+
+def add_command(commands):  # registers `python -m chess_env archive`
+    parser = commands.add_parser(
+        "archive", help="convert between PGN and the binary game archive"
+    )
+    actions = parser.add_subparsers(dest="action", required=True)
+
+    pack = actions.add_parser("pack", help="PGN files to an archive")
+    pack.add_argument("pgn", nargs="+", help="PGN files to convert")
+    pack.add_argument("--out", required=True, help="archive to write")
+    pack.add_argument(
+        "--skip-invalid", action="store_true", help="drop unreadable games"
+    )
+    pack.set_defaults(run=main_pack)
+
+    unpack = actions.add_parser("unpack", help="an archive to a PGN file")
+    unpack.add_argument("archive", help="archive to convert")
+    unpack.add_argument("--out", required=True, help="PGN file to write")
+    unpack.set_defaults(run=main_unpack)
+
+
+def main_pack(args):
+    games = pgn_to_archive(args.pgn, args.out, args.skip_invalid)
+    print(f"{games} games written to {args.out}", file=sys.stderr)
+    return 0
+
+
+def main_unpack(args):
+    games = archive_to_pgn(args.archive, args.out)
+    print(f"{games} games written to {args.out}", file=sys.stderr)
+    return 0
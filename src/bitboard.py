@@ -0,0 +1,139 @@
+"""
+This file is responsible to precompute bitboard tables used by move generation.
+
+A bitboard is a python int where bit `sq` is set when square `sq` is occupied.
+Squares are numbered `row * 8 + col` so that square 0 is a8 and square 63 is
+h1, the same layout as `Chessboard.board`.
+"""
+
+FULL = (1 << 64) - 1
+
+SQUARE_BB = [1 << sq for sq in range(64)]
+FILE_BB = [sum(1 << (row * 8 + col) for row in range(8)) for col in range(8)]
+ROW_BB = [0xFF << (row * 8) for row in range(8)]
+
+NOT_FILE_A = FULL ^ FILE_BB[0]
+NOT_FILE_H = FULL ^ FILE_BB[7]
+DARK_SQUARES = sum(1 << sq for sq in range(64) if (sq >> 3) + sq & 1)
+
+rook_directions = [(0, -1), (-1, 0), (0, 1), (1, 0)]
+bshp_directions = [(1, 1), (1, -1), (-1, 1), (-1, -1)]
+kght_offsets = [
+    (-2, -1),
+    (-2, 1),
+    (-1, 2),
+    (1, 2),
+    (2, 1),
+    (2, -1),
+    (1, -2),
+    (-1, -2),
+]
+king_offsets = [
+    (i, j) for i in [-1, 0, 1] for j in [-1, 0, 1] if (i != 0 or j != 0)
+]
+
+
+def is_valid_loc(row, col):
+    return 0 <= row <= 7 and 0 <= col <= 7
+
+
+def lsb(bb):  # index of the lowest set bit
+    return (bb & -bb).bit_length() - 1
+
+
+def iter_bits(bb):  # yields square indices of every set bit, lowest first
+    while bb:
+        low = bb & -bb
+        yield low.bit_length() - 1
+        bb ^= low
+
+
+def _fixed_attacks(offsets):
+    table = []
+    for sq in range(64):
+        row, col = divmod(sq, 8)
+        attacks = 0
+        for dr, dc in offsets:
+            if is_valid_loc(row + dr, col + dc):
+                attacks |= SQUARE_BB[(row + dr) * 8 + col + dc]
+        table.append(attacks)
+    return table
+
+
+KNIGHT_ATTACKS = _fixed_attacks(kght_offsets)
+KING_ATTACKS = _fixed_attacks(king_offsets)
+# PAWN_ATTACKS[is_white][sq]: squares a pawn of that colour on sq attacks
+PAWN_ATTACKS = [
+    _fixed_attacks([(1, -1), (1, 1)]),
+    _fixed_attacks([(-1, -1), (-1, 1)]),
+]
+
+
+def _slide(sq, occ, directions):  # slow reference used to fill the tables
+    row, col = divmod(sq, 8)
+    attacks = 0
+    for dr, dc in directions:
+        r, c = row + dr, col + dc
+        while is_valid_loc(r, c):
+            attacks |= SQUARE_BB[r * 8 + c]
+            if occ & SQUARE_BB[r * 8 + c]:
+                break
+            r, c = r + dr, c + dc
+    return attacks
+
+
+def _relevant_mask(sq, directions):  # ray squares whose occupancy matters
+    row, col = divmod(sq, 8)
+    mask = 0
+    for dr, dc in directions:
+        r, c = row + dr, col + dc
+        while is_valid_loc(r + dr, c + dc):
+            mask |= SQUARE_BB[r * 8 + c]
+            r, c = r + dr, c + dc
+    return mask
+
+
+def _slider_tables(directions):
+    masks, tables = [], []
+    for sq in range(64):
+        mask = _relevant_mask(sq, directions)
+        table = {}
+        subset = 0
+        while True:  # enumerate every subset of the mask (carry-rippler)
+            table[subset] = _slide(sq, subset, directions)
+            subset = (subset - mask) & mask
+            if subset == 0:
+                break
+        masks.append(mask)
+        tables.append(table)
+    return masks, tables
+
+
+ROOK_MASKS, ROOK_TABLES = _slider_tables(rook_directions)
+BSHP_MASKS, BSHP_TABLES = _slider_tables(bshp_directions)
+
+
+def rook_attacks(sq, occ):
+    return ROOK_TABLES[sq][occ & ROOK_MASKS[sq]]
+
+
+def bshp_attacks(sq, occ):
+    return BSHP_TABLES[sq][occ & BSHP_MASKS[sq]]
+
+
+def _between():
+    table = [[0] * 64 for _ in range(64)]
+    for sq in range(64):
+        row, col = divmod(sq, 8)
+        for dr, dc in rook_directions + bshp_directions:
+            ray = 0
+            r, c = row + dr, col + dc
+            while is_valid_loc(r, c):
+                table[sq][r * 8 + c] = ray
+                ray |= SQUARE_BB[r * 8 + c]
+                r, c = r + dr, c + dc
+    return table
+
+
+# BETWEEN[a][b]: squares strictly between a and b when they share a line
+BETWEEN = _between()
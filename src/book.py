@@ -0,0 +1,219 @@
+"""
+This file is responsible to build and read an opening book from PGN files.
+
+The book is a table of fixed size records (position key, move code, wins,
+draws, losses), sorted by key and move, with results counted for the side to
+move. The builder replays games through `Chessboard`, writes sorted runs of at
+most `run_size` records to temporary files and merges them, so memory use
+does not grow with the number of games. The reader memory-maps the table and
+binary-searches it, nothing is loaded up front.
+"""
+
+import heapq
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from chess_env import Chessboard, START_FEN
+from chess_error import ChessError
+import pgn
+
+MAGIC = b"CHBOOK1\0"
+HEADER = struct.Struct("<8sQ")  # magic, number of records
+RECORD = struct.Struct("<QIIII")  # key, move code, wins, draws, losses
+KEY = struct.Struct("<Q")
+
+# result -> index of the count to add for white, then for black
+result_index = {"1-0": (0, 2), "0-1": (2, 0), "1/2-1/2": (1, 1)}
+
+
+def write_run(stats, directory):  # sorted records into a temporary file
+    f = tempfile.NamedTemporaryFile(
+        dir=directory, prefix="book-run-", delete=False
+    )
+    with f:
+        for (key, code), counts in sorted(stats.items()):
+            f.write(RECORD.pack(key, code, *counts))
+    return f.name
+
+
+def read_run(path):
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(RECORD.size * 4096)
+            if not chunk:
+                return
+            yield from RECORD.iter_unpack(chunk)
+
+
+def merge_runs(run_paths, out_path):  # returns the number of records
+    tmp_path = out_path + ".tmp"
+    count = 0
+    with open(tmp_path, "wb") as out:
+        out.write(HEADER.pack(MAGIC, 0))
+        last = None
+        for record in heapq.merge(*(read_run(path) for path in run_paths)):
+            if last is not None and record[:2] == last[:2]:
+                # the same position and move from another run
+                last = (
+                    *last[:2],
+                    last[2] + record[2],
+                    last[3] + record[3],
+                    last[4] + record[4],
+                )
+                continue
+            if last is not None:
+                out.write(RECORD.pack(*last))
+                count += 1
+            last = record
+        if last is not None:
+            out.write(RECORD.pack(*last))
+            count += 1
+        out.seek(0)
+        out.write(HEADER.pack(MAGIC, count))
+    os.replace(tmp_path, out_path)
+    return count
+
+
+def build_book(paths, out_path, max_ply=None, run_size=1 << 20):
+    # replays every game with a result and counts it for the moves of its
+    # first max_ply half moves; returns a dict of statistics
+    if run_size <= 0:
+        raise ChessError(f"run size must be positive, got {run_size}")
+    directory = os.path.dirname(os.path.abspath(out_path))
+    stats = {}
+    run_paths = []
+    games = positions = 0
+    try:
+        for path in paths:
+            for game in pgn.read_games(path, skip_invalid=True):
+                if game.result not in result_index:
+                    continue  # unfinished game, nothing to count
+                index = result_index[game.result]
+                g = game.start_board()
+                for m in game.moves[:max_ply]:
+                    counts = stats.setdefault((g.key, m.code), [0, 0, 0])
+                    counts[index[not g.white_to_move]] += 1
+                    g.make_move(m, validate=False)
+                    positions += 1
+                    if len(stats) >= run_size:
+                        run_paths.append(write_run(stats, directory))
+                        stats = {}
+                games += 1
+        if stats or not run_paths:
+            run_paths.append(write_run(stats, directory))
+        records = merge_runs(run_paths, out_path)
+    finally:
+        for run_path in run_paths:
+            os.remove(run_path)
+    return {
+        "games": games,
+        "positions": positions,
+        "records": records,
+        "runs": len(run_paths),
+    }
+
+
+class OpeningBook:
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        try:
+            self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty file
+            self.file.close()
+            raise ChessError(f"{path} is not an opening book")
+        magic, self.size = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or len(self.mm) != (
+            HEADER.size + self.size * RECORD.size
+        ):
+            self.close()
+            raise ChessError(f"{path} is not an opening book")
+
+    def __len__(self):
+        return self.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.mm.close()
+        self.file.close()
+
+    def key_at(self, i):
+        return KEY.unpack_from(self.mm, HEADER.size + i * RECORD.size)[0]
+
+    def lookup(self, key):  # [(move code, wins, draws, losses)] for a key
+        lo, hi = 0, self.size
+        while lo < hi:  # first record with a key >= key
+            mid = (lo + hi) // 2
+            if self.key_at(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        entries = []
+        offset = HEADER.size + lo * RECORD.size
+        while offset < len(self.mm):
+            record = RECORD.unpack_from(self.mm, offset)
+            if record[0] != key:
+                break
+            entries.append(record[1:])
+            offset += RECORD.size
+        return entries
+
+    def probe(self, g: Chessboard):
+        # [(Move, wins, draws, losses)] for g, most played first; codes that
+        # are not legal on g (a key collision) are left out
+        entries = []
+        for code, wins, draws, losses in self.lookup(g.key):
+            m = g.find_move(code)
+            if m is not None:
+                entries.append((m, wins, draws, losses))
+        entries.sort(key=lambda e: e[1] + e[2] + e[3], reverse=True)
+        return entries
+
+
+def add_command(commands):  # registers `python -m chess_env book`
+    parser = commands.add_parser("book", help="build or probe an opening book")
+    actions = parser.add_subparsers(dest="action", required=True)
+
+    build = actions.add_parser("build", help="build a book from PGN files")
+    build.add_argument("pgn", nargs="+", help="PGN files to index")
+    build.add_argument("--out", required=True, help="book file to write")
+    build.add_argument(
+        "--max-ply", type=int, default=None, help="half moves to index"
+    )
+    build.add_argument(
+        "--run-size",
+        type=int,
+        default=1 << 20,
+        help="records kept in memory before spilling a sorted run",
+    )
+    build.set_defaults(run=main_build)
+
+    probe = actions.add_parser("probe", help="list the book moves of a FEN")
+    probe.add_argument("book", help="book file")
+    probe.add_argument("--fen", default=START_FEN)
+    probe.set_defaults(run=main_probe)
+
+
+def main_build(args):
+    stats = build_book(args.pgn, args.out, args.max_ply, args.run_size)
+    print(
+        f"{stats['games']} games {stats['positions']} positions "
+        f"{stats['records']} records from {stats['runs']} runs",
+        file=sys.stderr,
+    )
+    return 0
+
+
+def main_probe(args):
+    with OpeningBook(args.book) as book:
+        for m, wins, draws, losses in book.probe(
+            Chessboard.from_fen(args.fen)
+        ):
+            print(f"{m.uci}\t{wins}\t{draws}\t{losses}")
+    return 0
@@ -1,40 +1,156 @@
 """
 This class is responsible to store current game state and listing all valid moves.
+
+The position is kept as bitboards (see bitboard.py) plus a 64 entry list of
+pieces. `Chessboard.board` is an 8x8 array view of it for the UI.
+
+Moves are generated as int codes (see move.py), joined from tuples cached by
+end bitboard. `get_valid_codes` returns them as they are, for callers such as
+perft that only count or replay moves; `get_valid_moves` wraps them in Moves.
 """
-from typing import Iterable
+
+from sys import getsizeof
 from numpy import array, concatenate
+from bitboard import (
+    FULL,
+    SQUARE_BB,
+    ROW_BB,
+    NOT_FILE_A,
+    NOT_FILE_H,
+    DARK_SQUARES,
+    KNIGHT_ATTACKS,
+    KING_ATTACKS,
+    PAWN_ATTACKS,
+    ROOK_MASKS,
+    ROOK_TABLES,
+    BSHP_MASKS,
+    BSHP_TABLES,
+    BETWEEN,
+    lsb,
+    iter_bits,
+    rook_attacks,
+    bshp_attacks,
+)
 from chess_error import ChessError
-from move import Move
-
-import itertools
+from move import (
+    Move,
+    MOVE_MASK,
+    PROMOTION_SHIFT,
+    FLAG_CAPTURE,
+    FLAG_ENPASSANT,
+    FLAG_CASTLING,
+    FLAG_DOUBLE_PUSH,
+)
+from pst import PSQ, board_psq, unpack
+from zobrist import (
+    PIECE_KEYS,
+    BLACK_TO_MOVE_KEY,
+    CASTLING_KEYS,
+    ENPASSANT_KEYS,
+    position_key,
+)
 
 black_pieces = "pnbrqk"
 white_pieces = "PNBRQK"
 
-diag_movements = list(itertools.product([1, -1], [1, -1]))
-rook_movements = [[0, -1], [-1, 0], [0, 1], [1, 0]]  # straight movements
-L_movements = [
-    [-2, -1],  # going up twice and going left once
-    [-2, 1],
-    [-1, 2],
-    [1, 2],
-    [2, 1],
-    [2, -1],
-    [1, -2],
-    [-1, -2],
-]
-king_movements = [
-    [i, j] for i in [-1, 0, 1] for j in [-1, 0, 1] if (i != 0 or j != 0)
-]
-
-
-def is_valid_loc(row, col):
-    return 0 <= row <= 7 and 0 <= col <= 7
+START_FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+
+# king end square -> rook start and end squares when castling
+ctle_rook_squares = {58: (56, 59), 62: (63, 61), 2: (0, 3), 6: (7, 5)}
+
+# knight, bishop, rook, queen, as packed into a move code
+promotion_codes = [code << PROMOTION_SHIFT for code in [1, 2, 3, 4]]
+
+# memory of one Move, for sizing cached move lists
+MOVE_BYTES = getsizeof(Move.from_code(0, "P", "."))
+
+# rows a pawn promotes on, for either side
+PROMOTION_ROWS = ROW_BB[0] | ROW_BB[7]
+
+# killer codes with these bits were already tried as captures or promotions
+KILLER_SKIP = FLAG_CAPTURE | 7 << PROMOTION_SHIFT
+
+# sort weight of a piece when ordering captures, the king attacks last
+capture_order = {"P": 1, "N": 3, "B": 3, "R": 5, "Q": 9, "K": 10, ".": 0}
+capture_order.update({p.lower(): v for p, v in capture_order.items()})
+
+# castling rights kept when a move starts or ends on a square
+CASTLING_MASKS = [15] * 64
+for sq, lost in [(60, 3), (63, 1), (56, 2), (4, 12), (7, 4), (0, 8)]:
+    CASTLING_MASKS[sq] ^= lost
+
+# squares between king and rook that must be empty to castle
+ctle_empty_bb = {
+    "K": [
+        SQUARE_BB[57] | SQUARE_BB[58] | SQUARE_BB[59],
+        SQUARE_BB[61] | SQUARE_BB[62],
+    ],
+    "k": [
+        SQUARE_BB[1] | SQUARE_BB[2] | SQUARE_BB[3],
+        SQUARE_BB[5] | SQUARE_BB[6],
+    ],
+}
+
+# move codes to a set of end squares, cached by the end bitboard: per start
+# square for pieces, per direction (start = end + delta) for pawns. a move
+# list is then joined from a few tuples instead of built one code at a time
+PIECE_CODES = [{} for _ in range(64)]
+PAWN_CODES = [{}, {}]  # black, white
+# start square = end square + delta, for pushes, captures to the left and to
+# the right, and double pushes of black and white pawns
+PAWN_DELTAS = [[-8, -7, -9, -16], [8, 9, 7, 16]]
+CODE_CACHE_SIZE = 1 << 12  # end bitboards kept per cache before it is reset
+
+
+def piece_codes_to(cache, key, start):
+    # key is the end bitboard, with the ends that capture shifted above it
+    if len(cache) >= CODE_CACHE_SIZE:
+        cache.clear()
+    captures = key >> 64
+    codes = cache[key] = tuple(
+        start | end << 6 | FLAG_CAPTURE * (captures >> end & 1)
+        for end in iter_bits(key & FULL)
+    )
+    return codes
+
+
+def pawn_codes_to(cache, key, white):
+    # key holds the end bitboards of single pushes, captures to the left and
+    # to the right, and double pushes, 64 bits each. a pawn reaching the
+    # last row is one code per promotion piece
+    if len(cache) >= CODE_CACHE_SIZE:
+        cache.clear()
+    codes = []
+    for ends, delta, flags in zip(
+        [key & FULL, key >> 64 & FULL, key >> 128 & FULL, key >> 192],
+        PAWN_DELTAS[white],
+        [0, FLAG_CAPTURE, FLAG_CAPTURE, FLAG_DOUBLE_PUSH],
+    ):
+        for end in iter_bits(ends):
+            code = end + delta | end << 6 | flags
+            if SQUARE_BB[end] & PROMOTION_ROWS:
+                codes += [code | promotion for promotion in promotion_codes]
+            else:
+                codes.append(code)
+    codes = cache[key] = tuple(codes)
+    return codes
 
 
 class Chessboard:
+    debug_key = False  # recheck the key and scores from scratch after a move
+    move_cache = None  # a PositionCache to share legal move lists through
+
     def __init__(self):
-        self.board = array(
+        self.white_to_move = True
+        self.move_log = []
+        self.castling = 15  # bits: 1 = K, 2 = Q, 4 = k, 8 = q
+        self.ep_sq = None  # square a pawn can capture onto en passant
+        self.halfmoves = 0  # half moves since the last capture or pawn move
+        self.state_stack = []  # state each move in move_log can't restore
+        self.start_fullmove = 1
+        self._valid_set_key = None  # position the cached valid_move_set is of
+
+        self.set_board(
             [
                 ["r", ".", ".", ".", "k", ".", ".", "r"],
                 [".", ".", ".", ".", ".", ".", ".", "."],
@@ -47,12 +163,131 @@ class Chessboard:
             ]
         )
 
-        self.white_to_move = True
-        self.move_log = []
-        self.when_w_k_moved = None
-        self.when_b_k_moved = None
-        self.when_w_r_moved = [None] * 2  # queenside, kingside
-        self.when_b_r_moved = [None] * 2  # kingside, queenside
+    @classmethod
+    def from_fen(cls, fen: str):
+        fields = fen.split()
+        if len(fields) < 4:
+            raise ChessError(f"invalid FEN {fen!r}")
+        placement, side, castling, enpassant = fields[:4]
+
+        rows = []
+        for rank in placement.split("/"):
+            row = []
+            for piece in rank:
+                row += ["."] * int(piece) if piece.isdigit() else [piece]
+            if len(row) != 8:
+                raise ChessError(f"invalid FEN rank {rank!r}")
+            rows.append(row)
+        if len(rows) != 8 or side not in ["w", "b"]:
+            raise ChessError(f"invalid FEN {fen!r}")
+
+        g = cls()
+        g.white_to_move = side == "w"
+
+        g.castling = sum(1 << i for i, c in enumerate("KQkq") if c in castling)
+
+        if enpassant != "-":
+            try:
+                g.ep_sq = (
+                    Move.rank_to_row[enpassant[1]] * 8
+                    + Move.file_to_col[enpassant[0]]
+                )
+            except (KeyError, IndexError):
+                raise ChessError(f"invalid FEN en passant {enpassant!r}")
+
+        try:  # move counters are optional
+            g.halfmoves = int(fields[4]) if len(fields) > 4 else 0
+            g.start_fullmove = int(fields[5]) if len(fields) > 5 else 1
+        except ValueError:
+            raise ChessError(f"invalid FEN move counters {fen!r}")
+
+        g.set_board(rows)
+        return g
+
+    @classmethod
+    def from_history(cls, fen: str, codes):
+        # the board reached by playing move codes from fen, with its history
+        # so repeated positions are still seen; see history()
+        g = cls.from_fen(fen)
+        for code in codes:
+            m = g.find_move(code)
+            if m is None:
+                raise ChessError(f"illegal move {code:#07x} in history")
+            g.make_move(m, validate=False)
+        return g
+
+    def history(self):  # (start FEN, move codes) for from_history
+        moves = list(self.move_log)
+        for _ in moves:
+            self.undo_move()
+        fen = self.to_fen()
+        for m in moves:
+            self.make_move(m, validate=False)
+        return fen, [m.code for m in moves]
+
+    def to_fen(self):
+        ranks = []
+        for row in range(8):
+            rank, empty = "", 0
+            for piece in self.squares[row * 8 : row * 8 + 8]:
+                if piece == ".":
+                    empty += 1
+                    continue
+                rank += (str(empty) if empty else "") + piece
+                empty = 0
+            ranks.append(rank + (str(empty) if empty else ""))
+
+        castling = "".join(
+            c for i, c in enumerate("KQkq") if self.castling >> i & 1
+        )
+        ep_sq = self.ep_sq
+        enpassant = (
+            "-"
+            if ep_sq is None
+            else Move.col_to_file[ep_sq & 7] + Move.row_to_rank[ep_sq >> 3]
+        )
+
+        # half moves since the start position, counted as if it was white to
+        # move there, so that every two of them make a full move
+        started_black = self.white_to_move == (self.n_half_moves % 2 == 1)
+        half_moves = self.n_half_moves + started_black
+        return " ".join(
+            [
+                "/".join(ranks),
+                "w" if self.white_to_move else "b",
+                castling or "-",
+                enpassant,
+                str(self.halfmoves),
+                str(self.start_fullmove + half_moves // 2),
+            ]
+        )
+
+    def set_board(self, rows):  # place pieces from an 8x8 grid of chars
+        self.squares = [str(piece) for row in rows for piece in row]
+        if len(self.squares) != 64:
+            raise ChessError("board must have 8 rows of 8 squares")
+
+        self.bitboards = {piece: 0 for piece in white_pieces + black_pieces}
+        self.piece_counts = {piece: 0 for piece in self.bitboards}
+        self.occupied = [0, 0]  # black, white (index with white_to_move)
+        for sq, piece in enumerate(self.squares):
+            if piece == ".":
+                continue
+            if piece not in self.bitboards:
+                raise ChessError(f"The piece is unknown: {piece}")
+            self.bitboards[piece] |= SQUARE_BB[sq]
+            self.occupied[piece.isupper()] |= SQUARE_BB[sq]
+            self.piece_counts[piece] += 1
+        self._board_view = None
+        self.key = self.compute_key()
+        # material, piece-square scores and phase, packed, see pst.py
+        self.psq = board_psq(self.squares)
+
+    @property
+    def board(self):  # 8x8 array view, rebuilt lazily after the board changes
+        if self._board_view is None:
+            self._board_view = array(self.squares).reshape(8, 8)
+        return self._board_view
 
     @property
     def n_half_moves(self):
@@ -66,268 +301,667 @@ class Chessboard:
     def friend_pieces(self):
         return white_pieces if self.white_to_move else black_pieces
 
-    def make_move(self, m: Move):
-        if m not in self.get_valid_moves():
+    def hashed_enpassant_col(self):  # only hashed if a pawn can take there
+        ep_sq = self.ep_sq
+        if ep_sq is not None and (
+            PAWN_ATTACKS[not self.white_to_move][ep_sq]
+            & self.bitboards[self.friend_pieces[0]]
+        ):
+            return ep_sq & 7
+        return None
+
+    def compute_key(self):  # Zobrist key from scratch
+        return position_key(
+            self.squares,
+            self.white_to_move,
+            self.castling,
+            self.hashed_enpassant_col(),
+        )
+
+    def _state_key(self):  # part of the key for castling and en passant
+        ep_col = self.hashed_enpassant_col()
+        return CASTLING_KEYS[self.castling] ^ (
+            0 if ep_col is None else ENPASSANT_KEYS[ep_col]
+        )
+
+    def _check_key(self):  # also checks the piece-square scores
+        if self.key != self.compute_key():
+            raise ChessError(
+                f"Zobrist key {self.key:016x} out of sync, expected "
+                f"{self.compute_key():016x} after {self.move_log}"
+            )
+        if self.psq != board_psq(self.squares):
+            raise ChessError(
+                f"piece-square scores {unpack(self.psq)} out of sync, "
+                f"expected {unpack(board_psq(self.squares))} after "
+                f"{self.move_log}"
+            )
+
+    def eval_terms(self):  # (middlegame, endgame, phase), white's view
+        return unpack(self.psq)
+
+    def _put_piece(self, sq, piece):
+        self.squares[sq] = piece
+        self.bitboards[piece] |= SQUARE_BB[sq]
+        self.occupied[piece.isupper()] |= SQUARE_BB[sq]
+        self.piece_counts[piece] += 1
+        self.key ^= PIECE_KEYS[piece][sq]
+        self.psq += PSQ[piece][sq]
+
+    def _remove_piece(self, sq):
+        piece = self.squares[sq]
+        self.squares[sq] = "."
+        self.bitboards[piece] ^= SQUARE_BB[sq]
+        self.occupied[piece.isupper()] ^= SQUARE_BB[sq]
+        self.piece_counts[piece] -= 1
+        self.key ^= PIECE_KEYS[piece][sq]
+        self.psq -= PSQ[piece][sq]
+
+    def valid_move_set(self):  # legal moves of this position, as a set
+        if self._valid_set_key != self.key:
+            self._valid_set = set(self.get_valid_moves())
+            self._valid_set_key = self.key
+        return self._valid_set
+
+    def make_move(self, m: Move, validate=True):
+        # moves straight from get_valid_moves may skip validation
+        if validate and m not in self.valid_move_set():
             raise ChessError(f"invalid move {m}")
 
+        self.state_stack.append(
+            (
+                self.castling,
+                self.ep_sq,
+                self.halfmoves,
+                m.piece_captured,
+                self.key,
+            )
+        )
+        state_key = self._state_key()
         self.white_to_move = not self.white_to_move
         self.move_log.append(m)
+        self._board_view = None
 
-        # promotion move
-        self.board[m.end_row, m.end_col] = (
-            m.promote_to
-            if m.promote_to
-            else self.board[m.start_row, m.start_col]
-        )
-        self.board[m.start_row, m.start_col] = "."
+        code = m.code
+        start = code & 63
+        end = code >> 6 & 63
 
-        # enpassant move
-        if m.enpassant_capt_sq:
-            ep_row = m.enpassant_capt_sq[0]
-            ep_col = m.enpassant_capt_sq[1]
-            self.board[ep_row, ep_col] = "."
+        # capture, including enpassant
+        if code & FLAG_ENPASSANT:
+            self._remove_piece((start & 56) | (end & 7))
+        elif code & FLAG_CAPTURE:
+            self._remove_piece(end)
 
-        # castling move
-        if m.is_castling:
-            rook_row, which_rook = (
-                [7, "R"] if m.piece_moved == "K" else [0, "r"]
-            )
-            rook_col, rook_col_new = (
-                [0, 3] if m.is_castling == "queenside" else [7, 5]
-            )
+        # promotion move
+        piece = self.squares[start]
+        self._remove_piece(start)
+        self._put_piece(end, m.promote_to if code >> 12 & 7 else piece)
 
-            self.board[rook_row, rook_col_new] = which_rook
-            self.board[rook_row, rook_col] = "."
-
-        # remember when kings first moved
-        if not self.when_w_k_moved and m.piece_moved == "K":
-            self.when_w_k_moved = self.n_half_moves
-        if not self.when_b_k_moved and m.piece_moved == "k":
-            self.when_b_k_moved = self.n_half_moves
-
-        # remember when rooks first moved
-        if not self.when_w_r_moved[0] and self.board[-1, 0] != "R":
-            self.when_w_r_moved[0] = self.n_half_moves
-        if not self.when_w_r_moved[1] and self.board[-1, -1] != "R":
-            self.when_w_r_moved[1] = self.n_half_moves
-        if not self.when_b_r_moved[0] and self.board[0, 0] != "r":
-            self.when_b_r_moved[0] = self.n_half_moves
-        if not self.when_b_r_moved[1] and self.board[0, -1] != "r":
-            self.when_b_r_moved[1] = self.n_half_moves
+        # castling move
+        if code & FLAG_CASTLING:
+            rook_sq, rook_sq_new = ctle_rook_squares[end]
+            self._put_piece(rook_sq_new, self.squares[rook_sq])
+            self._remove_piece(rook_sq)
+
+        if code & FLAG_CAPTURE or piece in "pP":
+            self.halfmoves = 0
+        else:
+            self.halfmoves += 1
+        self.ep_sq = (start + end) // 2 if code & FLAG_DOUBLE_PUSH else None
+        # moving from or onto a king or rook square loses those rights
+        self.castling &= CASTLING_MASKS[start] & CASTLING_MASKS[end]
+
+        self.key ^= BLACK_TO_MOVE_KEY ^ state_key ^ self._state_key()
+        if self.debug_key:
+            self._check_key()
 
     def undo_move(self):
         if len(self.move_log) > 0:
             m: Move = self.move_log.pop()
+            castling, ep_sq, halfmoves, captured, key = self.state_stack.pop()
+            self._board_view = None
 
-            # undo en passant
-            if m.enpassant_capt_sq is None:
-                self.board[m.end_row, m.end_col] = m.piece_captured
-            else:
-                enpassant_row = m.enpassant_capt_sq[0]
-                enpassant_col = m.enpassant_capt_sq[1]
-                self.board[m.end_row, m.end_col] = "."
-                self.board[enpassant_row, enpassant_col] = "p"
-
-            # special undo for kings
-            if self.n_half_moves + 1 == self.when_w_k_moved:
-                self.when_w_k_moved = None
-            if self.n_half_moves + 1 == self.when_b_k_moved:
-                self.when_b_k_moved = None
-
-            # special undo for rooks
-            if self.n_half_moves + 1 == self.when_w_r_moved[0]:
-                self.when_w_r_moved[0] = None
-            if self.n_half_moves + 1 == self.when_w_r_moved[1]:
-                self.when_w_r_moved[1] = None
-            if self.n_half_moves + 1 == self.when_b_r_moved[0]:
-                self.when_b_r_moved[0] = None
-            if self.n_half_moves + 1 == self.when_b_r_moved[1]:
-                self.when_b_r_moved[1] = None
+            code = m.code
+            start = code & 63
+            end = code >> 6 & 63
 
             # special rook undo if castling
-            if m.is_castling == "queenside":
-                self.board[m.start_row, 3] = "."
-                self.board[m.start_row, 0] = "R" if m.end_row == 7 else "r"
-            elif m.is_castling == "kingside":
-                self.board[m.start_row, 5] = "."
-                self.board[m.start_row, 7] = "R" if m.end_row == 7 else "r"
-
-            self.board[m.start_row, m.start_col] = m.piece_moved
+            if code & FLAG_CASTLING:
+                rook_sq, rook_sq_new = ctle_rook_squares[end]
+                self._put_piece(rook_sq, self.squares[rook_sq_new])
+                self._remove_piece(rook_sq_new)
+
+            # put back the moving piece and whatever it captured
+            self._remove_piece(end)
+            self._put_piece(start, m.piece_moved)
+            if code & FLAG_ENPASSANT:
+                self._put_piece((start & 56) | (end & 7), captured)
+            elif code & FLAG_CAPTURE:
+                self._put_piece(end, captured)
+
+            self.castling, self.ep_sq, self.halfmoves = (
+                castling,
+                ep_sq,
+                halfmoves,
+            )
             self.white_to_move = not self.white_to_move
+            self.key = key
+            if self.debug_key:
+                self._check_key()
+
+    def make_null_move(self):  # pass the turn, for null move pruning
+        # None as the captured piece marks the state of a null move
+        self.state_stack.append(
+            (self.castling, self.ep_sq, self.halfmoves, None, self.key)
+        )
+        state_key = self._state_key()
+        self.white_to_move = not self.white_to_move
+        self.ep_sq = None
+        self.halfmoves += 1
+        self.key ^= BLACK_TO_MOVE_KEY ^ state_key ^ self._state_key()
+        if self.debug_key:
+            self._check_key()
+
+    def undo_null_move(self):  # null moves are not in move_log
+        castling, ep_sq, halfmoves, _, key = self.state_stack.pop()
+        self.castling, self.ep_sq, self.halfmoves = castling, ep_sq, halfmoves
+        self.white_to_move = not self.white_to_move
+        self.key = key
+        if self.debug_key:
+            self._check_key()
+
+    def repetitions(self):  # times the current position was seen before
+        # only positions since the last capture or pawn move can repeat, and
+        # only every other one has the same side to move. a line through a
+        # null move is no real repetition, the scan stops at the last one
+        stack = self.state_stack
+        last = min(self.halfmoves, len(stack))
+        key = self.key
+        count = 0
+        for i in range(2, last + 1, 2):
+            older, newer = stack[-i], stack[-i + 1]
+            if older[3] is None or newer[3] is None:
+                break
+            count += older[4] == key
+        return count
+
+    def is_insufficient_material(self):  # neither side can ever mate
+        counts = self.piece_counts
+        if any(counts[piece] for piece in "PpRrQq"):
+            return False
+        if counts["N"] + counts["n"] + counts["B"] + counts["b"] <= 1:
+            return True
+        if counts["N"] or counts["n"]:
+            return False
+        # any number of bishops all on squares of one colour
+        bishops = self.bitboards["B"] | self.bitboards["b"]
+        return not bishops & DARK_SQUARES or bishops & DARK_SQUARES == bishops
+
+    def game_over_reason(self, valid_moves=None):
+        # "checkmate", "stalemate", "insufficient_material", "fifty_moves",
+        # "threefold_repetition", or None while the game goes on. pass the
+        # legal moves if they are at hand to save generating one
+        if valid_moves is None:
+            no_moves = next(self.iter_moves(), None) is None
+        else:
+            no_moves = not valid_moves
+        if no_moves:
+            return "checkmate" if self.in_check() else "stalemate"
+        if self.is_insufficient_material():
+            return "insufficient_material"
+        if self.halfmoves >= 100:
+            return "fifty_moves"
+        if self.repetitions() >= 2:
+            return "threefold_repetition"
+        return None
+
+    def game_result(self):  # "1-0", "0-1", "1/2-1/2", or None if not over
+        reason = self.game_over_reason()
+        if reason is None:
+            return None
+        if reason == "checkmate":
+            return "0-1" if self.white_to_move else "1-0"
+        return "1/2-1/2"
+
+    def is_game_over(self):
+        return self.game_over_reason() is not None
+
+    def attackers_to(self, sq, occ, by_white):  # pieces attacking a square
+        pieces = white_pieces if by_white else black_pieces
+        bb = self.bitboards
+        queens = bb[pieces[4]]
+        return (
+            (PAWN_ATTACKS[not by_white][sq] & bb[pieces[0]])
+            | (KNIGHT_ATTACKS[sq] & bb[pieces[1]])
+            | (
+                BSHP_TABLES[sq][occ & BSHP_MASKS[sq]]
+                & (bb[pieces[2]] | queens)
+            )
+            | (
+                ROOK_TABLES[sq][occ & ROOK_MASKS[sq]]
+                & (bb[pieces[3]] | queens)
+            )
+            | (KING_ATTACKS[sq] & bb[pieces[5]])
+        )
 
-    def get_valid_moves(self):  # removes invalid moves from possible moves
-        return self.get_possible_moves()
-
-    def get_possible_moves(self):  # moves returned may be invalid
-        all_possible_moves = []
-
-        for i in range(8):
-            for j in range(8):
-                current_piece = self.board[i, j]
-                if current_piece == "." or current_piece in self.foe_pieces:
-                    continue
-                else:
-                    if current_piece.lower() == "p":
-                        all_possible_moves += self.get_pawn_moves(i, j)
-                    elif current_piece.lower() == "b":
-                        all_possible_moves += self.get_bshp_moves(i, j)
-                    elif current_piece.lower() == "n":
-                        all_possible_moves += self.get_kght_moves(i, j)
-                    elif current_piece.lower() == "r":
-                        all_possible_moves += self.get_rook_moves(i, j)
-                    elif current_piece.lower() == "q":
-                        all_possible_moves += self.get_bshp_moves(i, j)
-                        all_possible_moves += self.get_rook_moves(i, j)
-                    elif current_piece.lower() == "k":
-                        all_possible_moves += self.get_king_moves(i, j)
-                        all_possible_moves += self.get_ctle_moves()
-                    else:
-                        raise ChessError("The piece is unknown")
-
-        return all_possible_moves
-
-    def get_pawn_moves(self, r, c):
-        pawn_moves = []
-
-        if self.white_to_move:  # moving white pawn
-
-            # just pawn move
-            if self.board[r - 1, c] == ".":
-                if r == 1:  # promotion
-                    for p in self.friend_pieces[1:-1]:
-                        pawn_moves.append(Move([1, c], [0, c], self.board, p))
-                else:
-                    pawn_moves.append(Move([r, c], [r - 1, c], self.board))
-                    if r == 6 and self.board[4, c] == ".":  # double move
-                        pawn_moves.append(Move([6, c], [4, c], self.board))
-
-            # pawn move with regular capture
-            capt_moves = [
-                None if c == col else [r - 1, c + i]
-                for col, i in zip([0, 7], [-1, 1])
-            ]
-            for m in capt_moves:
-                if m is not None and self.board[m[0], m[1]] in self.foe_pieces:
-                    if r == 1:  # capture and promote
-                        for p in self.friend_pieces[1:-1]:
-                            pawn_moves.append(Move([r, c], m, self.board, p))
-                    else:  # just capture
-                        pawn_moves.append(Move([r, c], m, self.board))
-
-            # pawn move with enpassant capture
-            if r == 3:
-                last_move: Move = self.move_log[-1]
-                if (
-                    last_move.piece_moved == self.foe_pieces[0]  # enemy's pawn
-                    and last_move.start_row == 1
-                    and last_move.end_row == 3  # double move
-                    and abs(last_move.start_col - c) == 1  # column diff is 1
-                ):
-                    end_col = last_move.start_col  # or last_move.end_col
-                    pawn_moves.append(Move([r, c], [2, end_col], self.board))
-
-        else:  # moving black pawn
-
-            # just pawn move
-            if self.board[r + 1, c] == ".":
-                if r == 6:  # promotion
-                    for p in self.friend_pieces[1:-1]:
-                        pawn_moves.append(Move([6, c], [7, c], self.board, p))
-                else:
-                    pawn_moves.append(Move([r, c], [r + 1, c], self.board))
-                    if r == 1 and self.board[3, c] == ".":  # double move
-                        pawn_moves.append(Move([1, c], [3, c], self.board))
-
-            # pawn move with regular capture
-            capt_moves = [
-                None if c == col else [r + 1, c + i]
-                for col, i in zip([0, 7], [-1, 1])
-            ]
-            for m in capt_moves:
-                if m is not None and self.board[m[0], m[1]] in self.foe_pieces:
-                    if r == 6:  # capture and promote
-                        for p in self.friend_pieces[1:-1]:
-                            pawn_moves.append(Move([r, c], m, self.board, p))
-                    else:  # just capture
-                        pawn_moves.append(Move([r, c], m, self.board))
-
-            # pawn move with enpassant capture
-            if r == 4:
-                last_move: Move = self.move_log[-1]
-                if (
-                    last_move.piece_moved == self.foe_pieces[0]  # enemy's pawn
-                    and last_move.start_row == 6
-                    and last_move.end_row == 4  # double move
-                    and abs(last_move.start_col - c) == 1  # column diff is 1
-                ):
-                    end_col = last_move.start_col  # or last_move.end_col
-                    pawn_moves.append(Move([r, c], [5, end_col], self.board))
-
-        return pawn_moves
-
-    def get_bshp_moves(self, r, c):
-        return self.get_straight_moves(r, c, diag_movements)
-
-    def get_rook_moves(self, r, c):
-        return self.get_straight_moves(r, c, rook_movements)
-
-    def get_straight_moves(self, r, c, movetype_list: Iterable):
-        moves = []
-
-        for movetype in movetype_list:
-            new_row, new_col = r, c
-            while True:
-                new_row += movetype[0]
-                new_col += movetype[1]
-                if is_valid_loc(new_row, new_col):
-                    target_piece = self.board[new_row, new_col]
-                    if target_piece in self.friend_pieces:
-                        break
-                    else:
-                        moves.append(
-                            Move([r, c], [new_row, new_col], self.board)
-                        )
-                        if target_piece != ".":  # if it is enemy's piece
-                            break
-                else:  # going out of bound
-                    break
+    def king_sq(self):
+        king = self.bitboards[self.friend_pieces[-1]]
+        return lsb(king) if king else None
+
+    def in_check(self):
+        king_sq = self.king_sq()
+        if king_sq is None:
+            return False
+        occ = self.occupied[0] | self.occupied[1]
+        return self.attackers_to(king_sq, occ, not self.white_to_move) != 0
+
+    def get_legal_targets(self, king_sq):
+        # (king targets, targets of the other pieces, pins, checkers); the
+        # other pieces get no targets at all in double check. pins map a
+        # pinned square to the squares it may move to. attackers_to is
+        # inlined, as this runs for every position generated
+        foes = self.foe_pieces
+        bb = self.bitboards
+        pawns, knights, king = bb[foes[0]], bb[foes[1]], bb[foes[5]]
+        diagonal = bb[foes[2]] | bb[foes[4]]
+        straight = bb[foes[3]] | bb[foes[4]]
+        pawn_attacks = PAWN_ATTACKS[self.white_to_move]
+        occ = self.occupied[0] | self.occupied[1]
+        friends = self.occupied[self.white_to_move]
+
+        checkers = (
+            pawn_attacks[king_sq] & pawns
+            | KNIGHT_ATTACKS[king_sq] & knights
+            | BSHP_TABLES[king_sq][occ & BSHP_MASKS[king_sq]] & diagonal
+            | ROOK_TABLES[king_sq][occ & ROOK_MASKS[king_sq]] & straight
+        )
 
+        # the king may go to any square the enemy does not attack once the
+        # king itself stops blocking sliders
+        occ_without_king = occ ^ SQUARE_BB[king_sq]
+        king_targets = 0
+        steps = KING_ATTACKS[king_sq] & ~friends
+        while steps:
+            low = steps & -steps
+            steps ^= low
+            sq = low.bit_length() - 1
+            if not (
+                pawn_attacks[sq] & pawns
+                or KNIGHT_ATTACKS[sq] & knights
+                or KING_ATTACKS[sq] & king
+                or BSHP_TABLES[sq][occ_without_king & BSHP_MASKS[sq]]
+                & diagonal
+                or ROOK_TABLES[sq][occ_without_king & ROOK_MASKS[sq]]
+                & straight
+            ):
+                king_targets |= low
+
+        if checkers & (checkers - 1):  # double check, only the king moves
+            return king_targets, 0, {}, checkers
+
+        targets = FULL ^ friends
+        if checkers:  # capture the checker or block its line
+            checker_sq = lsb(checkers)
+            targets &= checkers | BETWEEN[king_sq][checker_sq]
+
+        # a lone friend between the king and a slider on its line is pinned
+        pins = {}
+        snipers = (ROOK_TABLES[king_sq][0] & straight) | (
+            BSHP_TABLES[king_sq][0] & diagonal
+        )
+        while snipers:
+            low = snipers & -snipers
+            snipers ^= low
+            line = BETWEEN[king_sq][low.bit_length() - 1]
+            blockers = line & occ
+            if blockers & friends and not blockers & (blockers - 1):
+                pins[lsb(blockers)] = line | low
+        return king_targets, targets, pins, checkers
+
+    def get_valid_moves(self):  # legal moves, from move_cache when set
+        cache = self.move_cache
+        if cache is None:
+            return self.generate_valid_moves()
+        moves = cache.get(self.key)
+        if moves is None:
+            moves = tuple(self.generate_valid_moves())
+            cache.put(
+                self.key, moves, getsizeof(moves) + MOVE_BYTES * len(moves)
+            )
+        return list(moves)
+
+    def generate_valid_moves(self):
+        return self.moves_of(self.get_valid_codes())
+
+    def get_valid_codes(self):  # legal move codes, without building Moves
+        king_sq = self.king_sq()
+        if king_sq is None:  # no king to protect
+            return self.get_possible_codes()
+
+        king_targets, targets, pins, checkers = self.get_legal_targets(king_sq)
+        valid_codes = self.get_king_codes(king_targets)
+        if not targets:
+            return valid_codes
+
+        valid_codes += self.get_pawn_codes(targets, pins)
+        valid_codes += self.get_kght_codes(targets, pins)
+        valid_codes += self.get_slider_codes(targets, pins)
+        if self.castling and not checkers:
+            valid_codes += self.get_ctle_codes(king_targets)
+
+        return valid_codes
+
+    def moves_of(self, codes):  # Moves for codes generated on this board
+        squares = self.squares
+        new_move = Move.from_code
+        moves = [
+            new_move(code, squares[code & 63], squares[code >> 6 & 63])
+            for code in codes
+        ]
+        if self.ep_sq is not None:  # the pawn taken is beside the start
+            for m in moves:
+                if m.code & FLAG_ENPASSANT:
+                    m.piece_captured = squares[m.code & 56 | m.code >> 6 & 7]
         return moves
 
-    def get_kght_moves(self, r, c):
-        return self.get_fixed_moves(r, c, L_movements)
-
-    def get_king_moves(self, r, c):
-        return self.get_fixed_moves(r, c, king_movements)
-
-    def get_fixed_moves(self, r, c, movetype_list: Iterable):
-        moves = []
-
-        for movetype in movetype_list:
-            new_row = r + movetype[0]
-            new_col = c + movetype[1]
-            if is_valid_loc(new_row, new_col):
-                target_piece = self.board[new_row, new_col]
-                if target_piece in "." + self.foe_pieces:
-                    moves.append(Move([r, c], [new_row, new_col], self.board))
+    def iter_moves(self, hash_code=None, killers=(), quiets=True, order=None):
+        # legal moves in stages for search: the hash move, captures by most
+        # valuable victim / least valuable attacker, promotions, killer
+        # moves, then quiet moves sorted by `order` if given. a stage is only
+        # generated once the one before it is used up
+        king_sq = self.king_sq()
+        if king_sq is None:  # no king to protect
+            yield from self.get_possible_moves()
+            return
+
+        legal = self.get_legal_targets(king_sq)
+        king_targets, targets, pins, checkers = legal
+        foes = self.occupied[not self.white_to_move]
+        empty = FULL ^ (self.occupied[0] | self.occupied[1])
+
+        if hash_code is not None:
+            hash_move = self.find_move(hash_code, legal)
+            hash_code = None if hash_move is None else hash_move.code
+            if hash_move is not None:
+                yield hash_move
+
+        captures = self.get_king_codes(king_targets & foes)
+        if targets:
+            capture_targets = targets & foes
+            captures += self.get_pawn_codes(capture_targets, pins)
+            captures += self.get_kght_codes(capture_targets, pins)
+            captures += self.get_slider_codes(capture_targets, pins)
+        captures = self.moves_of(captures)
+        captures.sort(
+            key=lambda m: capture_order[m.piece_moved]
+            - 16 * capture_order[m.piece_captured]
+        )
+        for m in captures:
+            if m.code != hash_code:
+                yield m
 
-        return moves
+        if targets:  # promotions without a capture
+            promotions = self.get_pawn_codes(
+                targets & empty & PROMOTION_ROWS, pins, enpassant=False
+            )
+            for m in self.moves_of(promotions):
+                if m.code != hash_code:
+                    yield m
+
+        if not quiets:
+            return
+
+        tried = {hash_code}
+        for code in killers:
+            if code is None or code in tried or code & KILLER_SKIP:
+                continue
+            killer = self.find_move(code, legal)
+            if (
+                killer is not None
+                and killer.code not in tried
+                and not killer.code & KILLER_SKIP
+            ):
+                tried.add(killer.code)
+                yield killer
+
+        quiet_codes = self.get_king_codes(king_targets & empty)
+        if targets:
+            quiet_targets = targets & empty
+            quiet_codes += self.get_pawn_codes(
+                quiet_targets & ~PROMOTION_ROWS, pins, enpassant=False
+            )
+            quiet_codes += self.get_kght_codes(quiet_targets, pins)
+            quiet_codes += self.get_slider_codes(quiet_targets, pins)
+        if not checkers:
+            quiet_codes += self.get_ctle_codes(king_targets)
+        quiet_moves = self.moves_of(quiet_codes)
+        if order is not None:
+            quiet_moves.sort(key=order)
+        for m in quiet_moves:
+            if m.code not in tried:
+                yield m
+
+    def find_move(self, code, legal=None):
+        # the legal move with this code, or None; checks only the one piece
+        # instead of generating every move. the flags of code are ignored, so
+        # start, end and promotion alone (code & MOVE_MASK) are enough
+        start, end = code & 63, code >> 6 & 63
+        piece = self.squares[start]
+        if piece not in self.friend_pieces:
+            return None
+        if legal is None:
+            king_sq = self.king_sq()
+            if king_sq is None:
+                legal = (
+                    FULL,
+                    FULL ^ self.occupied[self.white_to_move],
+                    None,
+                    0,
+                )
+            else:
+                legal = self.get_legal_targets(king_sq)
+        king_targets, targets, pins, checkers = legal
+
+        kind = piece.lower()
+        end_bb = SQUARE_BB[end]
+        if kind == "k":
+            if abs((end & 7) - (start & 7)) == 2:
+                codes = [] if checkers else self.get_ctle_codes(king_targets)
+            else:
+                codes = self.get_king_codes(king_targets & end_bb)
+        elif kind == "p":
+            if end == self.ep_sq:  # the captured pawn is beside start
+                end_bb |= SQUARE_BB[start & ~7 | end & 7]
+            codes = self.get_pawn_codes(targets & end_bb, pins)
+        elif kind == "n":
+            if pins and start in pins:
+                return None
+            codes = self.get_fixed_codes(
+                SQUARE_BB[start], KNIGHT_ATTACKS, targets & end_bb
+            )
+        else:
+            codes = self.get_slider_codes(
+                targets & end_bb, pins, SQUARE_BB[start]
+            )
 
-    def get_ctle_moves(self):  # get possible castling moves
-        castle_moves = []
+        code &= MOVE_MASK
+        for found in codes:
+            if found & MOVE_MASK == code:
+                return self.moves_of([found])[0]
+        return None
 
-        if self.white_to_move and not self.when_w_k_moved:
-            if not self.when_w_r_moved[0] and all(self.board[-1, 1:4] == "."):
-                castle_moves.append(Move([7, 4], [7, 2], self.board))
-            if not self.when_w_r_moved[1] and all(self.board[-1, 5:7] == "."):
-                castle_moves.append(Move([7, 4], [7, 6], self.board))
-        elif not self.white_to_move and not self.when_b_k_moved:
-            if not self.when_b_r_moved[0] and all(self.board[0, 1:4] == "."):
-                castle_moves.append(Move([0, 4], [0, 2], self.board))
-            if not self.when_b_r_moved[1] and all(self.board[0, 5:7] == "."):
-                castle_moves.append(Move([0, 4], [0, 6], self.board))
+    def get_possible_moves(self):  # moves returned may be invalid
+        return self.moves_of(self.get_possible_codes())
+
+    def get_possible_codes(self):
+        targets = FULL ^ self.occupied[self.white_to_move]
+
+        all_possible_codes = self.get_pawn_codes(targets)
+        all_possible_codes += self.get_kght_codes(targets)
+        all_possible_codes += self.get_slider_codes(targets)
+        all_possible_codes += self.get_king_codes(targets)
+        all_possible_codes += self.get_ctle_codes()
+
+        return all_possible_codes
+
+    def get_pawn_codes(self, targets=FULL, pins=None, enpassant=True):
+        pawn_codes = []
+        pawns = self.bitboards[self.friend_pieces[0]]
+        # a pinned pawn moves on its own, only along the pin line
+        for sq in pins or ():
+            if pawns & SQUARE_BB[sq]:
+                pawns ^= SQUARE_BB[sq]
+                pawn_codes += self.get_pawn_push_codes(
+                    SQUARE_BB[sq], targets & pins[sq]
+                )
+        pawn_codes += self.get_pawn_push_codes(pawns, targets)
+
+        # pawn move with enpassant capture
+        ep_sq = self.ep_sq if enpassant else None
+        if ep_sq is not None:
+            push = 8 if self.white_to_move else -8
+            capt_sq = ep_sq + push
+            if targets & (SQUARE_BB[ep_sq] | SQUARE_BB[capt_sq]):
+                pawns = self.bitboards[self.friend_pieces[0]]
+                attackers = PAWN_ATTACKS[not self.white_to_move][ep_sq] & pawns
+                for start in iter_bits(attackers):
+                    if pins is not None and not self.is_enpassant_safe(
+                        start, ep_sq, capt_sq
+                    ):
+                        continue
+                    pawn_codes.append(
+                        start | ep_sq << 6 | FLAG_CAPTURE | FLAG_ENPASSANT
+                    )
+
+        return pawn_codes
+
+    def get_pawn_push_codes(self, pawns, targets):
+        # pushes and captures of a set of pawns at once, without en passant.
+        # the four end bitboards are packed into one key, see pawn_codes_to
+        empty = FULL ^ (self.occupied[0] | self.occupied[1])
+        foes = self.occupied[not self.white_to_move] & targets
+        if self.white_to_move:  # moving white pawn, rows go down
+            single = (pawns >> 8) & empty
+            key = (
+                single & targets
+                | (((pawns & NOT_FILE_A) >> 9) & foes) << 64
+                | (((pawns & NOT_FILE_H) >> 7) & foes) << 128
+                | (((single & ROW_BB[5]) >> 8) & empty & targets) << 192
+            )
+        else:  # moving black pawn, rows go up
+            single = (pawns << 8) & empty
+            key = (
+                single & targets
+                | (((pawns & NOT_FILE_A) << 7) & foes) << 64
+                | (((pawns & NOT_FILE_H) << 9) & foes) << 128
+                | (((single & ROW_BB[2]) << 8) & empty & targets) << 192
+            )
+        if not key:
+            return ()
+        cache = PAWN_CODES[self.white_to_move]
+        return cache.get(key) or pawn_codes_to(cache, key, self.white_to_move)
+
+    def is_enpassant_safe(self, start, ep_sq, capt_sq):
+        # both pawns leave their row at once, which can expose the king to a
+        # slider that no single pin test sees
+        king_sq = self.king_sq()
+        foes = self.foe_pieces
+        bb = self.bitboards
+        occ = self.occupied[0] | self.occupied[1]
+        occ ^= SQUARE_BB[start] | SQUARE_BB[capt_sq] | SQUARE_BB[ep_sq]
+        queens = bb[foes[4]]
+        return not (
+            rook_attacks(king_sq, occ) & (bb[foes[3]] | queens)
+            or bshp_attacks(king_sq, occ) & (bb[foes[2]] | queens)
+        )
 
-        return castle_moves
+    def get_slider_codes(self, targets=FULL, pins=None, sliders=FULL):
+        # bishops, rooks and queens, of those only on `sliders` if given
+        pieces = self.friend_pieces
+        bb = self.bitboards
+        bishops, rooks = bb[pieces[2]], bb[pieces[3]]
+        sliders &= bishops | rooks | bb[pieces[4]]
+        codes = []
+        occ = self.occupied[0] | self.occupied[1]
+        foes = self.occupied[not self.white_to_move]
+
+        while sliders:
+            low = sliders & -sliders
+            sliders ^= low
+            start = low.bit_length() - 1
+            ends = 0
+            if not low & rooks:  # a bishop or a queen
+                ends = BSHP_TABLES[start][occ & BSHP_MASKS[start]]
+            if not low & bishops:  # a rook or a queen
+                ends |= ROOK_TABLES[start][occ & ROOK_MASKS[start]]
+            ends &= targets
+            if pins and start in pins:  # pinned sliders stay on the pin line
+                ends &= pins[start]
+            if ends:
+                # the captures are part of the key, they get FLAG_CAPTURE
+                key = ends | (ends & foes) << 64
+                cache = PIECE_CODES[start]
+                codes += cache.get(key) or piece_codes_to(cache, key, start)
+
+        return codes
+
+    def get_kght_codes(self, targets=FULL, pins=None):
+        knights = self.bitboards[self.friend_pieces[1]]
+        for sq in pins or ():  # a pinned knight can never move
+            knights &= ~SQUARE_BB[sq]
+        return self.get_fixed_codes(knights, KNIGHT_ATTACKS, targets)
+
+    def get_king_codes(self, targets=FULL):
+        king = self.bitboards[self.friend_pieces[-1]]
+        return self.get_fixed_codes(king, KING_ATTACKS, targets)
+
+    def get_fixed_codes(self, pieces, attack_table, targets):
+        codes = []
+        foes = self.occupied[not self.white_to_move]
+
+        while pieces:
+            low = pieces & -pieces
+            pieces ^= low
+            start = low.bit_length() - 1
+            ends = attack_table[start] & targets
+            if ends:
+                # the captures are part of the key, they get FLAG_CAPTURE
+                key = ends | (ends & foes) << 64
+                cache = PIECE_CODES[start]
+                codes += cache.get(key) or piece_codes_to(cache, key, start)
+
+        return codes
+
+    def get_ctle_codes(self, king_targets=None):
+        # possible castling moves; legal ones only when given the squares the
+        # king can safely step to, see get_legal_targets
+        castle_codes = []
+        occ = self.occupied[0] | self.occupied[1]
+
+        if self.white_to_move:
+            king, rook, rights = "K", "R", self.castling & 3
+        else:
+            king, rook, rights = "k", "r", self.castling >> 2
+
+        start = 60 if king == "K" else 4
+        if not rights or self.squares[start] != king:
+            return castle_codes
+        for side, end in enumerate([start - 2, start + 2]):
+            if (
+                not rights & (2 if side == 0 else 1)
+                or occ & ctle_empty_bb[king][side]
+                or self.squares[ctle_rook_squares[end][0]] != rook
+            ):
+                continue
+            # the king may not pass or land on an attacked square
+            if king_targets is not None and (
+                not king_targets & SQUARE_BB[(start + end) // 2]
+                or self.attackers_to(end, occ, king == "k")
+            ):
+                continue
+            castle_codes.append(start | end << 6 | FLAG_CASTLING)
+
+        return castle_codes
 
     def __str__(self):
         indexing_ui = array([["x", "0", "1", "2", "3", "4", "5", "6", "7"]])
@@ -338,9 +972,23 @@ class Chessboard:
 
 
 if __name__ == "__main__":
-    g = Chessboard()
-    m1 = Move([7, 4], [7, 6], g.board)
-    g.make_move(m1)
-    g.undo_move()
-
-    print("Hello")
+    import argparse
+    import sys
+    import archive
+    import book
+    import engine
+    import perft
+    import replay
+    import tablebase
+
+    parser = argparse.ArgumentParser(prog="chess_env")
+    commands = parser.add_subparsers(dest="command", required=True)
+    perft.add_command(commands)
+    replay.add_command(commands)
+    engine.add_command(commands)
+    book.add_command(commands)
+    archive.add_command(commands)
+    tablebase.add_command(commands)
+
+    args = parser.parse_args()
+    sys.exit(args.run(args))
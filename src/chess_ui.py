@@ -5,11 +5,14 @@ This file is responsible to handle UI and user input.
 import pygame as p
 import chess_env
 from chess_error import ChessError
+from engine_worker import EngineWorker
 from move import Move
 
 WIDTH = HEIGHT = 512 // 8 * 8
 SQUARE_SIZE = HEIGHT // 8
 MAX_FPS = 60
+ENGINE_SECONDS = 2.0  # time the engine thinks when asked to move with `e`
+ACTIVE_COLOR = p.Color(130, 151, 105)  # square of the selected piece
 IMAGES = {}
 SOUNDS = {}
 
@@ -31,14 +34,16 @@ def load_sounds():
 def main():
     p.init()
     p.display.set_caption("Chess")
-    screen = p.display.set_mode((WIDTH, HEIGHT))
-    screen.fill(p.Color("White"))
+    screen = p.display.set_mode((WIDTH, HEIGHT), p.RESIZABLE)
     clock = p.time.Clock()
     gs = chess_env.Chessboard()
     load_images()
     load_sounds()
+    cache = RenderCache(SQUARE_SIZE)
+    worker = EngineWorker(time_limit=ENGINE_SECONDS)
     last_click = ()
     clicks = []
+    thinking_shown = False
 
     running = True
     while running:
@@ -46,13 +51,23 @@ def main():
             if e.type == p.QUIT:
                 print("Bye bye!")
                 running = False
+            elif e.type == p.VIDEORESIZE:
+                screen = p.display.get_surface()
+                screen.fill(p.Color("White"))
+                cache.resize(max(min(e.w, e.h) // 8, 1))
+                p.display.flip()
             elif e.type == p.KEYDOWN:
                 if e.key == p.K_z:
+                    worker.cancel()
                     gs.undo_move()
+                elif e.key == p.K_e and not worker.thinking:
+                    worker.submit(gs)  # the engine plays the side to move
             elif e.type == p.MOUSEBUTTONDOWN:
                 pos = p.mouse.get_pos()
-                col = pos[0] // SQUARE_SIZE
-                row = pos[1] // SQUARE_SIZE
+                col = pos[0] // cache.square_size
+                row = pos[1] // cache.square_size
+                if row > 7 or col > 7:  # outside the board
+                    continue
                 if len(clicks) == 0:
                     if gs.board[row, col] in gs.friend_pieces:
                         last_click = (row, col)
@@ -63,66 +78,109 @@ def main():
                         clicks.append(last_click)
                         move = Move(clicks[0], clicks[1], gs.board)
                         try:
-                            gs.make_move(move)
-                            # play sound
-                            # if gs.in_check():
-                            #     p.mixer.Sound.play(SOUNDS["oof"])
-                            # elif
-                            if move.piece_captured == ".":
-                                p.mixer.Sound.play(SOUNDS["move"])
-                            else:
-                                p.mixer.Sound.play(SOUNDS["capture"])
+                            play_move(gs, move)
+                            worker.cancel()  # its position is gone
                         except ChessError as e:
                             print(e)
 
                     last_click = ()
                     clicks = []
 
+        # the engine runs in another process, only check for its answer
+        result = worker.poll()
+        if result is not None and result["move"] is not None:
+            play_move(gs, gs.find_move(result["move"]))
+        if worker.thinking != thinking_shown:  # the thinking indicator
+            thinking_shown = worker.thinking
+            p.display.set_caption(
+                "Chess - thinking..." if thinking_shown else "Chess"
+            )
+
         selected_piece = None if len(clicks) != 1 else clicks[0]
-        drawGameState(screen, gs, selected_piece)
+        dirty = drawGameState(screen, gs, selected_piece, cache)
+        if dirty:  # idle frames draw and update nothing
+            p.display.update(dirty)
         clock.tick(MAX_FPS)
-        p.display.flip()
-
-
-def drawGameState(screen, gs, active_square):
-    drawBoard(screen, active_square)
-    drawPieces(screen, gs.board)
-
-
-def drawBoard(screen, active_square):
+    worker.close()
+
+
+def play_move(gs, move):
+    gs.make_move(move)
+    # play sound
+    if gs.in_check():
+        p.mixer.Sound.play(SOUNDS["oof"])
+    elif move.piece_captured == ".":
+        p.mixer.Sound.play(SOUNDS["move"])
+    else:
+        p.mixer.Sound.play(SOUNDS["capture"])
+    if gs.is_game_over():
+        print(f"Game over: {gs.game_result()} ({gs.game_over_reason()})")
+
+
+class RenderCache:
+    # surfaces scaled once per square size, and what each square on screen
+    # currently shows so that only changed squares are drawn again
+    def __init__(self, square_size):
+        self.resize(square_size)
+
+    def resize(self, square_size):
+        self.square_size = square_size
+        self.sprites = {
+            piece: p.transform.smoothscale(image, (square_size, square_size))
+            for piece, image in IMAGES.items()
+        }
+        self.background = drawBoard(square_size)
+        self.shown = [None] * 64  # (piece, active) per square, None = redraw
+        self.last_state = None
+
+    def square_rect(self, sq):
+        size = self.square_size
+        return p.Rect((sq & 7) * size, (sq >> 3) * size, size, size)
+
+
+def drawGameState(screen, gs, active_square, cache):
+    # draws the squares that changed since the last call, returns their rects
+    state = (gs.key, active_square)
+    if state == cache.last_state:
+        return []
+    cache.last_state = state
+
+    dirty = []
+    active_sq = None
+    if active_square is not None:
+        active_sq = active_square[0] * 8 + active_square[1]
+    for sq, piece in enumerate(gs.squares):
+        shown = (piece, sq == active_sq)
+        if cache.shown[sq] != shown:
+            cache.shown[sq] = shown
+            dirty.append(drawSquare(screen, cache, sq, *shown))
+    return dirty
+
+
+def drawBoard(square_size):  # the empty board, rendered once per size
     colors = [
         p.Color(240, 215, 184),
         p.Color(179, 133, 104),
-        p.Color(130, 151, 105),
-    ]  # [light, dark, active_square]
-    rectangle = lambda row, col: p.Rect(
-        col * SQUARE_SIZE, row * SQUARE_SIZE, SQUARE_SIZE, SQUARE_SIZE
-    )
-    for row in range(8):
-        for col in range(8):
-            if active_square == (row, col):
-                color = colors[-1]
-            else:
-                color = colors[(row + col) % 2]
-            p.draw.rect(screen, color, rectangle(row, col))
-
-
-def drawPieces(screen, board):
+    ]  # [light, dark]
+    board = p.Surface((8 * square_size, 8 * square_size))
     for row in range(8):
         for col in range(8):
-            if board[row][col] != ".":
-                size_factor = 1.0
-                piece_size = size_factor * SQUARE_SIZE
-                piece_image = p.transform.smoothscale(
-                    IMAGES[board[row, col]], (piece_size, piece_size)
-                )
-                x_piece_draw = (
-                    col * SQUARE_SIZE + SQUARE_SIZE * (1 - size_factor) / 2
-                )
-                y_piece_draw = (
-                    row * SQUARE_SIZE + SQUARE_SIZE * (1 - size_factor) / 2
-                )
-                screen.blit(piece_image, (x_piece_draw, y_piece_draw))
+            rectangle = p.Rect(
+                col * square_size, row * square_size, square_size, square_size
+            )
+            p.draw.rect(board, colors[(row + col) % 2], rectangle)
+    return board
+
+
+def drawSquare(screen, cache, sq, piece, active):
+    rectangle = cache.square_rect(sq)
+    if active:
+        p.draw.rect(screen, ACTIVE_COLOR, rectangle)
+    else:
+        screen.blit(cache.background, rectangle, rectangle)
+    if piece != ".":
+        screen.blit(cache.sprites[piece], rectangle)
+    return rectangle
 
 
 if __name__ == "__main__":
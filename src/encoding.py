@@ -0,0 +1,57 @@
+"""
+This file is responsible to turn batches of boards into NumPy arrays for model
+training.
+
+Every board becomes 12 planes of 8x8 (one per piece, white first, in
+PLANE_PIECES order), a side-to-move flag and four castling flags (K, Q, k, q).
+The planes are unpacked straight from the bitboards, so no Python code runs
+per square.
+"""
+
+import numpy as np
+from chess_error import ChessError
+
+PLANE_PIECES = "PNBRQKpnbrqk"
+
+
+class BoardEncoder:
+    def __init__(self, capacity, dtype=np.float32):
+        # buffers are allocated once and reused by every call to encode
+        self.capacity = capacity
+        self.planes = np.zeros((capacity, 12, 8, 8), dtype=dtype)
+        self.side = np.zeros(capacity, dtype=dtype)  # 1 when white to move
+        self.castling = np.zeros((capacity, 4), dtype=dtype)
+
+    def encode(self, boards):  # returns views of the first len(boards) rows
+        n = len(boards)
+        if n > self.capacity:
+            raise ChessError(f"batch of {n} exceeds capacity {self.capacity}")
+
+        # one uint64 per (board, piece); bit sq of it is square sq
+        bitboards = np.fromiter(
+            (g.bitboards[piece] for g in boards for piece in PLANE_PIECES),
+            dtype=np.uint64,
+            count=n * 12,
+        )
+        bits = np.unpackbits(
+            bitboards.astype("<u8").view(np.uint8).reshape(n, 12, 8),
+            axis=-1,
+            bitorder="little",
+        )
+        self.planes[:n] = bits.reshape(n, 12, 8, 8)
+
+        self.side[:n] = np.fromiter(
+            (g.white_to_move for g in boards), dtype=bool, count=n
+        )
+        rights = np.fromiter(
+            (g.castling for g in boards), dtype=np.uint8, count=n
+        )
+        self.castling[:n] = (
+            rights[:, None] >> np.arange(4, dtype=np.uint8)
+        ) & 1
+
+        return self.planes[:n], self.side[:n], self.castling[:n]
+
+
+def encode_boards(boards, dtype=np.float32):  # one-off batch, no reuse
+    return BoardEncoder(len(boards), dtype).encode(boards)
@@ -0,0 +1,418 @@
+"""
+This file is responsible to choose a move by searching ahead from a board.
+
+The search is negamax alpha-beta with iterative deepening, a transposition
+table and quiescence search at the leaves, on a tapered material and
+piece-square evaluation (see pst.py). Moves come from Chessboard.iter_moves in
+order: the transposition table move, captures by most valuable victim / least
+valuable attacker, promotions, killer moves, then quiet moves by history
+score.
+"""
+
+import contextlib
+import time
+from chess_env import Chessboard, START_FEN
+from chess_error import ChessError
+from move import Move, FLAG_CAPTURE
+from profiling import PROFILER, Reporter
+from pst import tapered
+
+INFINITE = 1_000_000
+MATE = 100_000  # mate in n plies scores MATE - n
+MAX_PLY = 128
+NULL_MOVE_REDUCTION = 2  # plies a null move search is reduced by
+
+EVAL_BYTES = 100  # rough memory of one cached evaluation
+
+EXACT, LOWER, UPPER = 0, 1, 2  # transposition table bound types
+
+
+class SearchAborted(Exception):
+    pass
+
+
+class TranspositionTable:
+    def __init__(self, size=1 << 20):
+        # size is rounded down to a power of two so a key masks to a slot
+        self.size = 1 << max(size.bit_length() - 1, 0)
+        self.mask = self.size - 1
+        self.entries = [None] * self.size
+        self.generation = 0
+
+    def new_search(self):  # entries from older searches get replaced first
+        self.generation = (self.generation + 1) & 0xFF
+
+    def clear(self):
+        self.entries = [None] * self.size
+
+    def probe(self, key):  # (depth, score, bound, move code) or None
+        entry = self.entries[key & self.mask]
+        if entry is not None and entry[0] == key:
+            return entry[1:5]
+        return None
+
+    def store(self, key, depth, score, bound, move_code):
+        index = key & self.mask
+        old = self.entries[index]
+        # keep the deeper entry of the current search, replace anything else
+        if (
+            old is None
+            or old[0] == key
+            or old[5] != self.generation
+            or depth >= old[1]
+        ):
+            if move_code is None and old is not None and old[0] == key:
+                move_code = old[4]  # keep the best move we already know
+            self.entries[index] = (
+                key,
+                depth,
+                score,
+                bound,
+                move_code,
+                self.generation,
+            )
+
+
+class SearchResult:
+    def __init__(self, best_move, score, depth, nodes, seconds, pv):
+        self.best_move = best_move
+        self.score = score  # centipawns for the side to move
+        self.depth = depth
+        self.nodes = nodes
+        self.seconds = seconds
+        self.pv = pv
+
+    @property
+    def nps(self):
+        return self.nodes / self.seconds if self.seconds else 0.0
+
+    def __repr__(self):
+        return (
+            f"SearchResult({self.best_move} score {format_score(self.score)}"
+            f" depth {self.depth} nodes {self.nodes})"
+        )
+
+
+def format_score(score):
+    if abs(score) >= MATE - MAX_PLY:
+        plies = MATE - abs(score)
+        moves = (plies + 1) // 2
+        return f"mate {moves if score > 0 else -moves}"
+    return f"cp {score}"
+
+
+def print_iteration(info):  # default progress report, one line per depth
+    print(
+        f"depth {info.depth} score {format_score(info.score)} "
+        f"nodes {info.nodes} nps {info.nps:.0f} time {info.seconds:.2f}s "
+        f"pv {' '.join(m.uci for m in info.pv)}"
+    )
+
+
+def evaluate(g: Chessboard):
+    # material and piece-square scores for the side to move, kept up to date
+    # by the board, so this is a lookup rather than a scan of the squares
+    score = tapered(g.psq)
+    return score if g.white_to_move else -score
+
+
+class Engine:
+    def __init__(
+        self, tt_size=1 << 20, evaluate=evaluate, eval_cache=None, tt=None
+    ):
+        # tt replaces the private table, e.g. one shared between processes
+        self.tt = TranspositionTable(tt_size) if tt is None else tt
+        self.evaluate = evaluate
+        self.eval_cache = eval_cache  # optional PositionCache of evaluations
+        self.nodes = 0
+
+    def static_eval(self, g: Chessboard):
+        if self.eval_cache is None:
+            return self.evaluate(g)
+        score = self.eval_cache.get(g.key)
+        if score is None:
+            score = self.evaluate(g)
+            self.eval_cache.put(g.key, score, EVAL_BYTES)
+        return score
+
+    def search(
+        self,
+        g: Chessboard,
+        max_depth=MAX_PLY - 1,
+        time_limit=None,
+        node_limit=None,
+        on_iteration=print_iteration,
+        should_stop=None,
+        skip_depth=None,
+    ):
+        # iterative deepening, every finished depth is reported; a depth cut
+        # short by a limit is thrown away and the last finished one returned.
+        # depths for which skip_depth(depth) is true are not searched
+        self.nodes = 0
+        self.start = time.perf_counter()
+        self.deadline = None if time_limit is None else self.start + time_limit
+        self.node_limit = node_limit
+        self.should_stop = should_stop  # polled with the limits, True aborts
+        self.killers = [[None, None] for _ in range(MAX_PLY)]
+        self.history = {}
+        self.tt.new_search()
+
+        result = None
+        for depth in range(1, max_depth + 1):
+            if depth < max_depth and skip_depth and skip_depth(depth):
+                continue
+            self.pv_table = [[] for _ in range(MAX_PLY + 1)]
+            try:
+                score = self.negamax(g, depth, -INFINITE, INFINITE, 0)
+            except SearchAborted:  # every make_move is undone on the way up
+                break
+
+            pv = self.pv_table[0]
+            result = SearchResult(
+                pv[0] if pv else None,
+                score,
+                depth,
+                self.nodes,
+                time.perf_counter() - self.start,
+                list(pv),
+            )
+            if on_iteration:
+                on_iteration(result)
+            if not pv or abs(score) >= MATE - MAX_PLY:
+                break  # no legal move, or a forced mate was found
+            if self.deadline and time.perf_counter() > self.deadline:
+                break
+
+        if result is None:  # not even depth 1 finished, pick any move
+            moves = g.get_valid_moves()
+            result = SearchResult(
+                moves[0] if moves else None,
+                0,
+                0,
+                self.nodes,
+                time.perf_counter() - self.start,
+                moves[:1],
+            )
+        return result
+
+    def check_limits(self):
+        if self.node_limit is not None and self.nodes >= self.node_limit:
+            raise SearchAborted
+        if self.deadline is not None and time.perf_counter() >= self.deadline:
+            raise SearchAborted
+        if self.should_stop is not None and self.should_stop():
+            raise SearchAborted
+
+    def quiet_order(self, m: Move):  # quiet moves with more cutoffs first
+        return -self.history.get((m.piece_moved, m.code >> 6 & 63), 0)
+
+    def negamax(self, g: Chessboard, depth, alpha, beta, ply, null_ok=True):
+        self.nodes += 1
+        if self.nodes & 1023 == 0:
+            self.check_limits()
+        self.pv_table[ply] = []
+
+        key = g.key
+        # a repeated position, in the game or this line, is scored as a draw
+        if ply and g.repetitions():
+            return 0
+
+        in_check = g.in_check()
+        # so is the fifty move rule, unless the side to move is mated, which
+        # game_over_reason also checks first
+        if ply and g.halfmoves >= 100:
+            if in_check and next(g.iter_moves(), None) is None:
+                return -MATE + ply
+            return 0
+        if depth <= 0 and not in_check:
+            return self.quiescence(g, alpha, beta, ply)
+
+        alpha_orig = alpha
+        tt_move = None
+        entry = self.tt.probe(key)
+        if entry is not None:
+            tt_depth, tt_score, tt_bound, tt_move = entry
+            if ply and tt_depth >= depth:
+                tt_score = score_from_tt(tt_score, ply)
+                if tt_bound == EXACT:
+                    return tt_score
+                if tt_bound == LOWER and tt_score >= beta:
+                    return tt_score
+                if tt_bound == UPPER and tt_score <= alpha:
+                    return tt_score
+
+        if ply >= MAX_PLY - 1:
+            return self.static_eval(g)
+
+        # null move pruning: if passing still fails high, so will a move.
+        # not tried in check, right after another null move, or with only
+        # pawns left where zugzwang is common
+        pieces = g.friend_pieces
+        if (
+            ply
+            and null_ok
+            and depth > NULL_MOVE_REDUCTION
+            and not in_check
+            and beta < MATE - MAX_PLY
+            and any(g.bitboards[p] for p in pieces[1:5])
+        ):
+            g.make_null_move()
+            try:
+                score = -self.negamax(
+                    g,
+                    depth - 1 - NULL_MOVE_REDUCTION,
+                    -beta,
+                    1 - beta,
+                    ply + 1,
+                    null_ok=False,
+                )
+            finally:
+                g.undo_null_move()
+            if score >= beta:
+                return beta
+
+        best_score = -INFINITE
+        best_move = None
+        # moves come lazily in stages, a cutoff skips generating the rest
+        for m in g.iter_moves(
+            tt_move, tuple(self.killers[ply]), order=self.quiet_order
+        ):
+            g.make_move(m, validate=False)
+            try:
+                # a check extends the line by one ply
+                score = -self.negamax(
+                    g, depth - 1 + in_check, -beta, -alpha, ply + 1
+                )
+            finally:
+                g.undo_move()
+
+            if score > best_score:
+                best_score = score
+                best_move = m
+                if score > alpha:
+                    alpha = score
+                    self.pv_table[ply] = [m] + self.pv_table[ply + 1]
+                    if alpha >= beta:
+                        if not m.code & FLAG_CAPTURE:
+                            self.update_quiet_stats(m, depth, ply)
+                        break
+
+        if best_move is None:  # no legal move
+            return -MATE + ply if in_check else 0
+        if best_score <= alpha_orig:
+            bound = UPPER
+        elif best_score >= beta:
+            bound = LOWER
+        else:
+            bound = EXACT
+        self.tt.store(
+            key,
+            depth,
+            score_to_tt(best_score, ply),
+            bound,
+            best_move.code,
+        )
+        return best_score
+
+    def update_quiet_stats(self, m: Move, depth, ply):
+        killers = self.killers[ply]
+        if killers[0] != m.code:
+            killers[1] = killers[0]
+            killers[0] = m.code
+        index = (m.piece_moved, m.code >> 6 & 63)
+        self.history[index] = self.history.get(index, 0) + depth * depth
+
+    def quiescence(self, g: Chessboard, alpha, beta, ply):
+        # only captures and promotions, until the position is quiet
+        self.nodes += 1
+        if self.nodes & 1023 == 0:
+            self.check_limits()
+        self.pv_table[ply] = []
+
+        stand_pat = self.static_eval(g)
+        if stand_pat >= beta or ply >= MAX_PLY - 1:
+            return stand_pat
+        alpha = max(alpha, stand_pat)
+
+        for m in g.iter_moves(quiets=False):
+            g.make_move(m, validate=False)
+            try:
+                score = -self.quiescence(g, -beta, -alpha, ply + 1)
+            finally:
+                g.undo_move()
+            if score > alpha:
+                alpha = score
+                self.pv_table[ply] = [m] + self.pv_table[ply + 1]
+                if alpha >= beta:
+                    break
+        return alpha
+
+
+def score_to_tt(score, ply):  # mate scores are stored relative to the node
+    if score >= MATE - MAX_PLY:
+        return score + ply
+    if score <= -MATE + MAX_PLY:
+        return score - ply
+    return score
+
+
+def score_from_tt(score, ply):
+    if score >= MATE - MAX_PLY:
+        return score - ply
+    if score <= -MATE + MAX_PLY:
+        return score + ply
+    return score
+
+
+def add_command(commands):  # registers `python -m chess_env search`
+    parser = commands.add_parser("search", help="search for the best move")
+    parser.add_argument("--fen", default=START_FEN)
+    parser.add_argument("--depth", type=int, default=MAX_PLY - 1)
+    parser.add_argument("--time", type=float, default=None, help="seconds")
+    parser.add_argument("--nodes", type=int, default=None)
+    parser.add_argument(
+        "--tt-size", type=int, default=1 << 20, help="table entries"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="processes searching in parallel with a shared table",
+    )
+    parser.add_argument(
+        "--profile",
+        type=float,
+        default=None,
+        metavar="SECONDS",
+        help="report hot path counts as JSON lines every SECONDS on stderr",
+    )
+    parser.set_defaults(run=main)
+
+
+def main(args):
+    if args.time is None and args.nodes is None and args.depth >= MAX_PLY - 1:
+        args.time = 5.0  # never search without any limit from the command line
+    with contextlib.ExitStack() as stack:
+        if args.workers > 1:
+            if args.profile is not None:  # the profiler only sees this process
+                raise ChessError("--profile needs a single worker")
+            import parallel_search
+
+            # closed even if the search fails, so no worker or shared
+            # memory is left behind
+            engine = stack.enter_context(
+                parallel_search.ParallelEngine(args.workers, args.tt_size)
+            )
+        else:
+            engine = Engine(args.tt_size)
+        if args.profile is not None:
+            PROFILER.enable()
+            stack.enter_context(Reporter(PROFILER, every=args.profile))
+        result = engine.search(
+            Chessboard.from_fen(args.fen),
+            max_depth=args.depth,
+            time_limit=args.time,
+            node_limit=args.nodes,
+        )
+    print(f"bestmove {result.best_move.uci if result.best_move else '(none)'}")
+    return 0
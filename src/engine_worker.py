@@ -0,0 +1,97 @@
+"""
+This file is responsible to run the engine in a background process.
+
+The UI submits positions and polls for the moves found, so a search never
+blocks its event loop. Only the latest job counts: submitting or cancelling
+bumps a shared job number, a search stops as soon as it sees that its number
+is no longer current, and results of older jobs are dropped.
+"""
+
+import multiprocessing
+import queue
+from chess_env import Chessboard
+from engine import Engine
+
+
+def search_jobs(jobs, results, current_job, tt_size):  # runs in the worker
+    engine = Engine(tt_size)
+    while True:
+        job = jobs.get()
+        if job is None:  # asked to shut down
+            return
+        job_id, (fen, codes), time_limit, max_depth = job
+        if current_job.value != job_id:  # cancelled while queued
+            continue
+        result = engine.search(
+            Chessboard.from_history(fen, codes),
+            max_depth=max_depth,
+            time_limit=time_limit,
+            on_iteration=None,
+            should_stop=lambda: current_job.value != job_id,
+        )
+        best = result.best_move
+        results.put(
+            {
+                "job": job_id,
+                "move": best.code if best else None,
+                "score": result.score,
+                "depth": result.depth,
+                "nodes": result.nodes,
+            }
+        )
+
+
+class EngineWorker:
+    def __init__(self, time_limit=2.0, max_depth=64, tt_size=1 << 18):
+        self.time_limit = time_limit
+        self.max_depth = max_depth
+        # spawn so the worker does not inherit the parent's pygame state
+        context = multiprocessing.get_context("spawn")
+        self.jobs = context.Queue()
+        self.results = context.Queue()
+        self.current_job = context.Value("q", 0)
+        self.pending = None  # job id submitted and not answered yet
+        self.process = context.Process(
+            target=search_jobs,
+            args=(self.jobs, self.results, self.current_job, tt_size),
+            daemon=True,
+        )
+        self.process.start()
+
+    @property
+    def thinking(self):
+        return self.pending is not None
+
+    def submit(self, g: Chessboard):  # search g, cancelling any older job
+        with self.current_job.get_lock():
+            self.current_job.value += 1
+            job_id = self.current_job.value
+        self.pending = job_id
+        # the moves so far go along, for the search to see repetitions
+        self.jobs.put((job_id, g.history(), self.time_limit, self.max_depth))
+        return job_id
+
+    def cancel(self):  # stop the current job, its result will never show
+        if self.pending is not None:
+            with self.current_job.get_lock():
+                self.current_job.value += 1
+            self.pending = None
+
+    def poll(self):
+        # result dict of the pending job if it finished, else None; never
+        # waits, so it is safe to call once per frame
+        while True:
+            try:
+                result = self.results.get_nowait()
+            except queue.Empty:
+                return None
+            if result["job"] == self.pending:
+                self.pending = None
+                return result
+
+    def close(self):
+        self.cancel()
+        self.jobs.put(None)
+        self.process.join(timeout=1)
+        if self.process.is_alive():
+            self.process.terminate()
@@ -1,12 +1,29 @@
-from functools import cached_property
-from typing import List
+"""
+This file is responsible to describe a single move.
+
+A move is packed into an int: bits 0-5 start square, bits 6-11 end square,
+bits 12-14 promotion piece and bits 15-18 flags, with squares numbered
+`row * 8 + col`. `Move` wraps the code together with the moving and captured
+pieces; two moves are equal when their codes and pieces are.
+"""
+
 import numpy as np
 
 black_pieces = ["p", "b", "n", "r", "q", "k"]
 white_pieces = ["P", "B", "N", "R", "Q", "K"]
 
+PROMOTION_PIECES = ".nbrq"  # index is the promotion code, 0 means none
+PROMOTION_SHIFT = 12
+FLAG_CAPTURE = 1 << 15
+FLAG_ENPASSANT = 2 << 15
+FLAG_CASTLING = 4 << 15
+FLAG_DOUBLE_PUSH = 8 << 15
+MOVE_MASK = (1 << 15) - 1  # start, end and promotion, without the flags
+
 
 class Move:
+    __slots__ = ("code", "piece_moved", "piece_captured")
+
     col_to_file = {i: chr(i + 97) for i in range(8)}
     file_to_col = {chr(i + 97): i for i in range(8)}
     row_to_rank = {i: str(8 - i) for i in range(8)}
@@ -19,36 +36,83 @@ class Move:
         board: np.ndarray,
         promote_to=None,
     ):
-        self.start_row = start[0]
-        self.start_col = start[1]
-        self.end_row = end[0]
-        self.end_col = end[1]
-        self.piece_moved = board[self.start_row, self.start_col]
-        self.piece_captured = board[self.end_row, self.end_col]
-        self.promote_to = promote_to
-
-        if (
-            self.piece_moved.lower() == "p"
-            and self.piece_captured == "."
-            and self.end_col != self.start_col
-        ):  # this is enpassant move
-            self.piece_captured = board[self.start_row, self.end_col]
-            self.enpassant_capt_sq = [self.start_row, self.end_col]
-        else:
-            self.enpassant_capt_sq = None
-
-    @cached_property
+        start_sq = start[0] * 8 + start[1]
+        end_sq = end[0] * 8 + end[1]
+        self.piece_moved = str(board[start[0], start[1]])
+        self.piece_captured = str(board[end[0], end[1]])
+
+        flags = FLAG_CAPTURE if self.piece_captured != "." else 0
+        if self.piece_moved.lower() == "p":
+            if self.piece_captured == "." and end[1] != start[1]:
+                # this is enpassant move
+                self.piece_captured = str(board[start[0], end[1]])
+                flags = FLAG_CAPTURE | FLAG_ENPASSANT
+            elif abs(end[0] - start[0]) == 2:
+                flags = FLAG_DOUBLE_PUSH
+        elif self.piece_moved.lower() == "k" and abs(end[1] - start[1]) == 2:
+            flags = FLAG_CASTLING
+
+        promotion = (
+            PROMOTION_PIECES.index(promote_to.lower()) if promote_to else 0
+        )
+        self.code = (
+            start_sq | end_sq << 6 | promotion << PROMOTION_SHIFT | flags
+        )
+
+    @classmethod
+    def from_code(cls, code, piece_moved, piece_captured):
+        # fast constructor for the move generator, does not read the board
+        m = cls.__new__(cls)
+        m.code = code
+        m.piece_moved = piece_moved
+        m.piece_captured = piece_captured
+        return m
+
+    @property
+    def start_sq(self):
+        return self.code & 63
+
+    @property
+    def end_sq(self):
+        return self.code >> 6 & 63
+
+    @property
+    def start_row(self):
+        return self.code >> 3 & 7
+
+    @property
+    def start_col(self):
+        return self.code & 7
+
+    @property
+    def end_row(self):
+        return self.code >> 9 & 7
+
+    @property
+    def end_col(self):
+        return self.code >> 6 & 7
+
+    @property
+    def promote_to(self):
+        promotion = self.code >> PROMOTION_SHIFT & 7
+        if not promotion:
+            return None
+        piece = PROMOTION_PIECES[promotion]
+        return piece.upper() if self.piece_moved.isupper() else piece
+
+    @property
+    def enpassant_capt_sq(self):
+        if self.code & FLAG_ENPASSANT:
+            return [self.start_row, self.end_col]
+        return None
+
+    @property
     def is_castling(self):
-        if self.piece_moved.lower() == "k":
-            column_change = self.start_col - self.end_col
-            if column_change < -1.5:  # castling kingside
-                return "kingside"
-            elif column_change > 1.5:  # castling queenside
-                return "queenside"
-            else:
-                return None
-
-    @cached_property
+        if self.code & FLAG_CASTLING:
+            return "kingside" if self.end_col == 6 else "queenside"
+        return None
+
+    @property
     def chess_notation(self):
         if self.is_castling:
             return "O-O-O" if self.is_castling == "queenside" else "O-O"
@@ -60,20 +124,27 @@ class Move:
         notation += f"={self.promote_to}" if self.promote_to else ""
         return notation
 
+    @property
+    def uci(self):  # long algebraic notation, e.g. e7e8q
+        notation = self.get_file_rank(self.start_row, self.start_col)
+        notation += self.get_file_rank(self.end_row, self.end_col)
+        promotion = self.code >> PROMOTION_SHIFT & 7
+        return notation + (PROMOTION_PIECES[promotion] if promotion else "")
+
     def get_file_rank(self, r, c):
         return self.col_to_file[c] + self.row_to_rank[r]
 
     def __repr__(self):
         return self.chess_notation
 
+    def __hash__(self):
+        return self.code
+
     def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Move):
+            return NotImplemented
         return (
-            self.start_row == other.start_row
-            and self.start_col == other.start_col
-            and self.end_row == other.end_row
-            and self.end_col == other.end_col
-            and self.promote_to == other.promote_to
+            self.code == other.code
             and self.piece_moved == other.piece_moved
             and self.piece_captured == other.piece_captured
-            and self.enpassant_capt_sq == other.enpassant_capt_sq
         )
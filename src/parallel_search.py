@@ -0,0 +1,285 @@
+"""
+This file is responsible to search one position with several processes.
+
+The search is lazy SMP: every worker process runs the normal iterative
+deepening search on its own Chessboard, and all of them share one
+transposition table in shared memory, so what one worker learns cuts the tree
+of the others. Helper workers skip some depths, which keeps them from all
+searching the same depth in the same order. The coordinator hands out the
+position, stops every worker at the shared deadline or node limit, or as soon
+as one of them finishes, and keeps the deepest completed iteration. Node
+counts are summed over the workers.
+
+The table is lock-free: an entry is two 64-bit words, the data and the key
+xor the data. A write torn by another process no longer matches its key, so
+it reads as a miss instead of as a wrong entry.
+"""
+
+import multiprocessing
+import os
+import queue
+import time
+from multiprocessing import shared_memory
+from chess_env import Chessboard
+from chess_error import ChessError
+from engine import Engine, MAX_PLY, print_iteration, SearchResult
+
+# entry data bits: move code (19, 0 for none), bound (2), depth (8),
+# generation (8), score (22, stored with an offset to keep it positive)
+MOVE_BITS = (1 << 19) - 1
+SCORE_OFFSET = 1 << 21
+POLL_SECONDS = 0.01  # how often the coordinator checks the limits
+
+# depth skipping of the helpers, from Stockfish: helper i skips a block of
+# SKIP_SIZE[i] depths out of every two, shifted by SKIP_PHASE[i]
+SKIP_SIZE = [1, 1, 2, 2, 2, 2, 3, 3, 3, 3, 3, 3, 4, 4, 4, 4, 4, 4, 4, 4]
+SKIP_PHASE = [0, 1, 0, 1, 2, 3, 0, 1, 2, 3, 4, 5, 0, 1, 2, 3, 4, 5, 6, 7]
+
+
+class SharedTranspositionTable:
+    # same interface as engine.TranspositionTable. Without a name a new table
+    # is created and owned, with the name of an existing one it is attached
+    def __init__(self, size=1 << 20, name=None):
+        self.size = 1 << max(size.bit_length() - 1, 0)
+        self.mask = self.size - 1
+        self.owner = name is None
+        nbytes = 8 * (1 + 2 * self.size)  # generation, then the entries
+        if self.owner:  # new shared memory is zero filled
+            self.shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.words = self.shm.buf.cast("Q")
+        self.generation = self.words[0]
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def new_search(self):
+        # the owner starts a new generation, attached tables pick it up
+        if self.owner:
+            self.words[0] = (self.words[0] + 1) & 0xFF
+        self.generation = self.words[0]
+
+    def clear(self):
+        self.shm.buf[8:] = bytes(len(self.shm.buf) - 8)
+
+    def probe(self, key):  # (depth, score, bound, move code) or None
+        i = 2 * (key & self.mask) + 1
+        data = self.words[i + 1]
+        if data and self.words[i] ^ data == key:
+            return (
+                data >> 21 & 0xFF,
+                (data >> 37) - SCORE_OFFSET,
+                data >> 19 & 3,
+                data & MOVE_BITS or None,
+            )
+        return None
+
+    def store(self, key, depth, score, bound, move_code):
+        i = 2 * (key & self.mask) + 1
+        words = self.words
+        old = words[i + 1]
+        same_key = old and words[i] ^ old == key
+        # keep the deeper entry of the current search, replace anything else
+        if (
+            not old
+            or same_key
+            or old >> 29 & 0xFF != self.generation
+            or depth >= old >> 21 & 0xFF
+        ):
+            if move_code is None and same_key:
+                move_code = old & MOVE_BITS  # keep the best move we know
+            data = (
+                (move_code or 0)
+                | bound << 19
+                | depth << 21
+                | self.generation << 29
+                | score + SCORE_OFFSET << 37
+            )
+            words[i + 1] = data  # data first, a reader in between misses
+            words[i] = key ^ data
+
+    def close(self):  # the owner also frees the shared memory
+        self.words.release()
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def helper_skips(index):  # skip_depth of worker index, None for the main one
+    if index == 0:
+        return None
+    size = SKIP_SIZE[(index - 1) % len(SKIP_SIZE)]
+    phase = SKIP_PHASE[(index - 1) % len(SKIP_PHASE)]
+    return lambda depth: (depth + phase) // size % 2 == 1
+
+
+def search_jobs(index, jobs, results, stop, node_counts, tt_name, tt_size):
+    # runs in worker `index`, reports iterations and the end of every job
+    tt = SharedTranspositionTable(tt_size, name=tt_name)
+    engine = Engine(tt=tt)
+    skip_depth = helper_skips(index)
+    results.put(("ready", 0))
+
+    def should_stop():  # polled every 1024 nodes
+        node_counts[index] = engine.nodes
+        return stop.is_set()
+
+    while True:
+        job = jobs.get()
+        if job is None:  # asked to shut down
+            tt.close()
+            return
+        job_id, (fen, codes), max_depth, time_limit = job
+
+        def report(info):
+            node_counts[index] = engine.nodes
+            codes = [m.code for m in info.pv]
+            results.put(("iteration", job_id, info.depth, info.score, codes))
+
+        engine.search(
+            Chessboard.from_history(fen, codes),
+            max_depth=max_depth,
+            time_limit=time_limit,
+            on_iteration=report,
+            should_stop=should_stop,
+            skip_depth=skip_depth,
+        )
+        node_counts[index] = engine.nodes
+        results.put(("done", job_id))
+
+
+class ParallelEngine:
+    # a pool of search processes sharing one transposition table; search()
+    # works like Engine.search and the pool is reused between searches
+    def __init__(self, workers=None, tt_size=1 << 20):
+        self.workers = workers or os.cpu_count() or 1
+        self.tt = SharedTranspositionTable(tt_size)
+        context = multiprocessing.get_context("spawn")
+        self.results = context.Queue()
+        self.stop = context.Event()
+        self.node_counts = context.RawArray("q", self.workers)
+        self.jobs = []
+        self.processes = []
+        self.job_id = 0
+        for index in range(self.workers):
+            jobs = context.Queue()
+            process = context.Process(
+                target=search_jobs,
+                args=(
+                    index,
+                    jobs,
+                    self.results,
+                    self.stop,
+                    self.node_counts,
+                    self.tt.name,
+                    self.tt.size,
+                ),
+                daemon=True,
+            )
+            process.start()
+            self.jobs.append(jobs)
+            self.processes.append(process)
+        # wait for every worker, so start up does not eat the first deadline
+        for _ in range(self.workers):
+            self.results.get()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def nodes(self):  # summed over the workers
+        return sum(self.node_counts)
+
+    def search(
+        self,
+        g: Chessboard,
+        max_depth=MAX_PLY - 1,
+        time_limit=None,
+        node_limit=None,
+        on_iteration=print_iteration,
+    ):
+        # reports every new deepest iteration of any worker; the node limit
+        # is checked against the sum, so it may overshoot by a few thousand
+        self.job_id += 1
+        fen = g.to_fen()
+        history = g.history()  # so the workers see repeated positions
+        start = time.perf_counter()
+        deadline = None if time_limit is None else start + time_limit
+        self.stop.clear()
+        self.node_counts[:] = [0] * self.workers
+        self.tt.new_search()
+        for jobs in self.jobs:
+            jobs.put((self.job_id, history, max_depth, time_limit))
+
+        result = None
+        running = self.workers
+        while running:
+            try:
+                message = self.results.get(timeout=POLL_SECONDS)
+            except queue.Empty:
+                message = None
+                if not all(p.is_alive() for p in self.processes):
+                    raise ChessError("a search worker died")
+            if message is not None and message[1] == self.job_id:
+                if message[0] == "done":  # one worker finished, stop all
+                    running -= 1
+                    self.stop.set()
+                elif result is None or message[2] > result.depth:
+                    _, _, depth, score, codes = message
+                    pv = self.replay_pv(fen, codes)
+                    result = SearchResult(
+                        pv[0] if pv else None,
+                        score,
+                        depth,
+                        self.nodes,
+                        time.perf_counter() - start,
+                        pv,
+                    )
+                    if on_iteration:
+                        on_iteration(result)
+            now = time.perf_counter()
+            if (deadline is not None and now >= deadline) or (
+                node_limit is not None and self.nodes >= node_limit
+            ):
+                self.stop.set()
+
+        seconds = time.perf_counter() - start
+        if result is None:  # not even depth 1 finished, pick any move
+            moves = g.get_valid_moves()
+            return SearchResult(
+                moves[0] if moves else None,
+                0,
+                0,
+                self.nodes,
+                seconds,
+                moves[:1],
+            )
+        result.nodes = self.nodes
+        result.seconds = seconds
+        return result
+
+    def replay_pv(self, fen, codes):  # move codes of a worker to Moves
+        g = Chessboard.from_fen(fen)
+        pv = []
+        for code in codes:
+            m = g.find_move(code)
+            if m is None:
+                break
+            g.make_move(m, validate=False)
+            pv.append(m)
+        return pv
+
+    def close(self):
+        self.stop.set()
+        for jobs in self.jobs:
+            jobs.put(None)
+        for process in self.processes:
+            process.join(timeout=1)
+            if process.is_alive():
+                process.terminate()
+        self.tt.close()
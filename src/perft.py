@@ -0,0 +1,172 @@
+"""
+This file is responsible to count the positions reachable from a board (perft).
+
+Known node counts catch move generator bugs, and the time taken to reach them
+tracks make_move/undo_move/get_valid_moves throughput across releases.
+"""
+
+import json
+import platform
+import time
+from chess_env import Chessboard, START_FEN
+
+# reference positions with their node counts at depth 1, 2, 3...
+# see https://www.chessprogramming.org/Perft_Results
+PERFT_SUITE = [
+    ("startpos", START_FEN, [20, 400, 8902, 197281, 4865609]),
+    (
+        "kiwipete",  # castling, en passant, promotion, pins
+        "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+        [48, 2039, 97862, 4085603],
+    ),
+    (
+        "endgame",  # en passant discovered checks along the rank
+        "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1",
+        [14, 191, 2812, 43238, 674624],
+    ),
+    (
+        "promotion",  # promotions with capture, black may still castle
+        "r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1",
+        [6, 264, 9467, 422333],
+    ),
+    (
+        "promotion_check",
+        "rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8",
+        [44, 1486, 62379, 2103487],
+    ),
+    (
+        "middlegame",
+        "r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 "
+        "w - - 0 10",
+        [46, 2079, 89890, 3894594],
+    ),
+]
+
+
+def perft(g: Chessboard, depth):
+    if depth == 0:
+        return 1
+
+    codes = g.get_valid_codes()
+    if depth == 1:  # leaves are counted, not visited or turned into Moves
+        return len(codes)
+
+    nodes = 0
+    for m in g.moves_of(codes):
+        g.make_move(m, validate=False)
+        nodes += perft(g, depth - 1)
+        g.undo_move()
+    return nodes
+
+
+def divide(g: Chessboard, depth):
+    # node count below every root move, keyed by UCI move like the divide
+    # output of other engines so the two can be diffed
+    counts = {}
+    for m in g.get_valid_moves():
+        g.make_move(m, validate=False)
+        counts[m.uci] = perft(g, depth - 1)
+        g.undo_move()
+    return counts
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def run_suite(max_nodes=200_000):
+    results = []
+    for name, fen, counts in PERFT_SUITE:
+        # deepest depth that stays within the node budget, at least depth 1
+        depth = max(
+            [d for d, n in enumerate(counts, start=1) if n <= max_nodes],
+            default=1,
+        )
+        nodes, seconds = timed(perft, Chessboard.from_fen(fen), depth)
+        results.append(
+            {
+                "name": name,
+                "fen": fen,
+                "depth": depth,
+                "nodes": nodes,
+                "expected": counts[depth - 1],
+                "ok": nodes == counts[depth - 1],
+                "seconds": seconds,
+                "nps": nodes / seconds if seconds else 0.0,
+            }
+        )
+    return results
+
+
+def suite_report(results):
+    nodes = sum(r["nodes"] for r in results)
+    seconds = sum(r["seconds"] for r in results)
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "positions": results,
+        "nodes": nodes,
+        "seconds": seconds,
+        "nps": nodes / seconds if seconds else 0.0,
+        "ok": all(r["ok"] for r in results),
+    }
+
+
+def add_command(commands):  # registers `python -m chess_env perft`
+    parser = commands.add_parser(
+        "perft", help="count leaf nodes of the move generator"
+    )
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--fen", default=START_FEN)
+    parser.add_argument(
+        "--divide", action="store_true", help="show node count per move"
+    )
+    parser.add_argument(
+        "--suite",
+        action="store_true",
+        help="check the reference positions against known node counts",
+    )
+    parser.add_argument(
+        "--max-nodes",
+        type=int,
+        default=200_000,
+        help="deepest depth per suite position whose count is below this",
+    )
+    parser.add_argument(
+        "--json", default=None, help="write suite results to this file"
+    )
+    parser.set_defaults(run=main)
+
+
+def main(args):
+    if args.suite:
+        report = suite_report(run_suite(args.max_nodes))
+        for r in report["positions"]:
+            status = "ok" if r["ok"] else f"FAIL expected {r['expected']}"
+            print(
+                f"{r['name']:<16} depth {r['depth']} {r['nodes']:>10} nodes"
+                f" {r['nps']:>10.0f} nps  {status}"
+            )
+        print(f"total {report['nodes']} nodes {report['nps']:.0f} nps")
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(report, f, indent=2)
+        return 0 if report["ok"] else 1
+
+    g = Chessboard.from_fen(args.fen)
+    if args.divide:
+        counts, seconds = timed(divide, g, args.depth)
+        for move, nodes in counts.items():
+            print(f"{move}: {nodes}")
+        nodes = sum(counts.values())
+    else:
+        nodes, seconds = timed(perft, g, args.depth)
+
+    nps = nodes / seconds if seconds else 0.0
+    print(
+        f"depth {args.depth} nodes {nodes} time {seconds:.3f}s {nps:.0f} nps"
+    )
+    return 0
@@ -0,0 +1,267 @@
+"""
+This file is responsible to read games from PGN files.
+
+Files are memory-mapped and read one game at a time, so memory use does not
+grow with the file. A byte range can be given to read only the games that
+start inside it, which lets several readers split one file.
+"""
+
+import mmap
+import re
+from chess_env import Chessboard, START_FEN
+from chess_error import ChessError
+from move import Move, FLAG_CAPTURE
+
+TAG_RE = re.compile(rb'^\[(\w+)\s+"(.*)"\s*\]')
+TOKEN_RE = re.compile(
+    r"\{[^}]*\}?"  # comment
+    r"|;[^\n]*"  # rest of line comment
+    r"|[()]"  # variation
+    r"|\$\d+"  # numeric annotation
+    r"|1-0|0-1|1/2-1/2|\*"  # result
+    r"|\d+\.+"  # move number
+    r"|[^\s(){};$]+"  # SAN
+)
+SAN_RE = re.compile(
+    r"^([NBRQK])?([a-h])?([1-8])?x?([a-h][1-8])(?:=?([NBRQ]))?[+#]?[!?]*$"
+)
+CASTLING_RE = re.compile(r"^([O0]-[O0](?:-[O0])?)[+#]?[!?]*$")
+RESULTS = {"1-0", "0-1", "1/2-1/2", "*"}
+
+
+class PGNGame:
+    def __init__(self, headers, moves, offset):
+        self.headers = headers  # tag name -> value, in file order
+        self.moves = moves  # list of Move, None when reading headers only
+        self.offset = offset  # byte offset of the first tag in the file
+
+    @property
+    def result(self):
+        return self.headers.get("Result", "*")
+
+    def start_board(self):
+        fen = self.headers.get("FEN", START_FEN)
+        return Chessboard.from_fen(fen)
+
+    def __repr__(self):
+        white = self.headers.get("White", "?")
+        black = self.headers.get("Black", "?")
+        return f"PGNGame({white} - {black} {self.result})"
+
+
+def san_to_move(g: Chessboard, san: str):  # resolve SAN against valid moves
+    castling = CASTLING_RE.match(san)
+    if castling:
+        end_col = 2 if len(castling.group(1)) == 5 else 6
+        for m in g.get_valid_moves():
+            if m.is_castling and m.end_col == end_col:
+                return m
+        raise ChessError(f"illegal castling {san}")
+
+    parsed = SAN_RE.match(san)
+    if not parsed:
+        raise ChessError(f"cannot parse move {san!r}")
+    piece, file, rank, end, promotion = parsed.groups()
+
+    piece = piece or "P"
+    end_sq = Move.rank_to_row[end[1]] * 8 + Move.file_to_col[end[0]]
+    col = Move.file_to_col[file] if file else None
+    row = Move.rank_to_row[rank] if rank else None
+    promotion = promotion.lower() if promotion else None
+
+    found = None
+    for m in g.get_valid_moves():
+        if (
+            m.code >> 6 & 63 == end_sq
+            and m.piece_moved.upper() == piece
+            and (col is None or m.start_col == col)
+            and (row is None or m.start_row == row)
+            and (m.promote_to.lower() if m.promote_to else None) == promotion
+        ):
+            if found is not None:
+                raise ChessError(f"ambiguous move {san}")
+            found = m
+    if found is None:
+        raise ChessError(f"illegal move {san}")
+    return found
+
+
+def move_to_san(g: Chessboard, m: Move, valid_moves=None):
+    # SAN of the legal move m, on g before m is made
+    if m.is_castling:
+        san = "O-O" if m.is_castling == "kingside" else "O-O-O"
+    else:
+        end = m.get_file_rank(m.end_row, m.end_col)
+        capture = "x" if m.code & FLAG_CAPTURE else ""
+        if m.piece_moved in "pP":
+            file = Move.col_to_file[m.start_col] if capture else ""
+            san = file + capture + end
+            if m.promote_to:
+                san += "=" + m.promote_to.upper()
+        else:
+            # name the start file, else rank, else both, when another piece
+            # of the same kind can go to the same square
+            others = [
+                other
+                for other in valid_moves or g.get_valid_moves()
+                if other.piece_moved == m.piece_moved
+                and other.end_sq == m.end_sq
+                and other.start_sq != m.start_sq
+            ]
+            start = ""
+            if others:
+                file, rank = m.get_file_rank(m.start_row, m.start_col)
+                if all(other.start_col != m.start_col for other in others):
+                    start = file
+                elif all(other.start_row != m.start_row for other in others):
+                    start = rank
+                else:
+                    start = file + rank
+            san = m.piece_moved.upper() + start + capture + end
+
+    g.make_move(m, validate=False)
+    if g.in_check():
+        san += "#" if next(g.iter_moves(), None) is None else "+"
+    g.undo_move()
+    return san
+
+
+def parse_movetext(g: Chessboard, movetext: str):  # plays the moves on g
+    moves = []
+    depth = 0  # inside a variation when above 0
+    for token in TOKEN_RE.findall(movetext):
+        first = token[0]
+        if first == "(":
+            depth += 1
+        elif first == ")":
+            depth -= 1
+        elif depth or first in "{;$" or token in RESULTS or token[-1] == ".":
+            continue
+        else:
+            m = san_to_move(g, token)
+            g.make_move(m, validate=False)
+            moves.append(m)
+    return moves
+
+
+def format_movetext(g: Chessboard, moves, result="*"):
+    # SAN movetext of moves played from g, wrapped at 79 columns; g is left
+    # at the start position
+    tokens = []
+    for ply, m in enumerate(moves):
+        if g.white_to_move:
+            tokens.append(f"{g.start_fullmove + (g.n_half_moves + 1) // 2}.")
+        elif ply == 0:
+            tokens.append(f"{g.start_fullmove + g.n_half_moves // 2}...")
+        tokens.append(move_to_san(g, m))
+        g.make_move(m, validate=False)
+    for _ in moves:
+        g.undo_move()
+    tokens.append(result)
+
+    lines, line = [], ""
+    for token in tokens:
+        if line and len(line) + 1 + len(token) > 79:
+            lines.append(line)
+            line = token
+        else:
+            line = f"{line} {token}" if line else token
+    return "\n".join(lines + [line])
+
+
+def format_game(game: PGNGame):  # the PGN text of a game
+    tags = "".join(
+        '[{} "{}"]\n'.format(
+            name, value.replace("\\", "\\\\").replace('"', '\\"')
+        )
+        for name, value in game.headers.items()
+    )
+    movetext = format_movetext(game.start_board(), game.moves, game.result)
+    return f"{tags}\n{movetext}\n\n"
+
+
+def write_games(games, path):  # writes PGNGame objects to a PGN file
+    count = 0
+    with open(path, "w", encoding="utf-8") as f:
+        for game in games:
+            f.write(format_game(game))
+            count += 1
+    return count
+
+
+def parse_headers(tag_lines):
+    headers = {}
+    for line in tag_lines:
+        tag = TAG_RE.match(line)
+        if tag:
+            value = tag.group(2).replace(b'\\"', b'"').replace(b"\\\\", b"\\")
+            headers[tag.group(1).decode()] = value.decode("utf-8", "replace")
+    return headers
+
+
+def iter_raw_games(mm, start=0, stop=None, keep_movetext=True):
+    # yields (offset, tag lines, movetext lines) of games starting in range
+    stop = len(mm) if stop is None else stop
+
+    # a game starts at a tag line that does not follow another tag line
+    mm.seek(start)
+    if start > 0 and mm[start - 1 : start] != b"\n":
+        mm.readline()  # skip the rest of a line cut by the range start
+    pos = mm.tell()
+    prev_start = mm.rfind(b"\n", 0, max(pos - 1, 0)) + 1
+    prev_is_tag = pos > 0 and mm[prev_start : prev_start + 1] == b"["
+
+    game = None
+    while True:
+        offset = mm.tell()
+        line = mm.readline()
+        if not line:
+            break
+        is_tag = line[:1] == b"["
+        if is_tag and not prev_is_tag:
+            if game is not None:
+                yield game
+                game = None
+            if offset >= stop:
+                return
+            game = (offset, [line], [])
+        elif game is not None:
+            if is_tag:
+                game[1].append(line)
+            elif keep_movetext and line.strip():
+                game[2].append(line)
+        prev_is_tag = is_tag
+
+    if game is not None:
+        yield game
+
+
+def read_games(
+    path, headers_only=False, start=0, stop=None, skip_invalid=False
+):
+    # yields PGNGame for every game starting in the byte range [start, stop)
+    with open(path, "rb") as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty file, nothing to map
+            return
+        with mm:
+            for offset, tag_lines, movetext_lines in iter_raw_games(
+                mm, start, stop, keep_movetext=not headers_only
+            ):
+                headers = parse_headers(tag_lines)
+                if headers_only:
+                    yield PGNGame(headers, None, offset)
+                    continue
+
+                game = PGNGame(headers, [], offset)
+                try:
+                    game.moves = parse_movetext(
+                        game.start_board(),
+                        b"".join(movetext_lines).decode("utf-8", "replace"),
+                    )
+                except ChessError as e:
+                    if skip_invalid:
+                        continue
+                    raise ChessError(f"{game} at byte {offset}: {e}")
+                yield game
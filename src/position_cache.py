@@ -0,0 +1,63 @@
+"""
+This file is responsible to remember results per position, such as move lists
+and evaluations, within a fixed budget.
+
+Entries are keyed by the Zobrist key of the position and evicted least
+recently used first once the entry or byte limit is reached. Hits, misses and
+evictions are counted so the limits can be sized for a workload.
+"""
+
+from collections import OrderedDict
+from chess_error import ChessError
+
+
+class PositionCache:
+    def __init__(self, max_entries=None, max_bytes=None):
+        if max_entries is None and max_bytes is None:
+            raise ChessError("a position cache needs an entry or byte limit")
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (value, bytes), oldest first
+        self.bytes = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):  # the cached value, or None
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, value, nbytes=0):
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.bytes -= old[1]
+        self.entries[key] = (value, nbytes)
+        self.bytes += nbytes
+        while (
+            self.max_entries is not None
+            and len(self.entries) > self.max_entries
+        ) or (self.max_bytes is not None and self.bytes > self.max_bytes):
+            _, (_, evicted_bytes) = self.entries.popitem(last=False)
+            self.bytes -= evicted_bytes
+            self.evictions += 1
+
+    def clear(self):  # drops the entries, keeps the counters
+        self.entries.clear()
+        self.bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
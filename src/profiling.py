@@ -0,0 +1,141 @@
+"""
+This file is responsible to count calls and time spent in the move generator
+hot paths while a job runs.
+
+Profiling is opt-in: `enable()` swaps the HOT_PATHS methods of Chessboard for
+counting wrappers and `disable()` puts the originals back, so nothing is
+measured, and nothing costs, while it is off. A snapshot holds, per method,
+the number of calls and the cumulative seconds (including nested calls), plus
+the number of moves generated per piece type. Snapshots from several
+processes can be merged, and `Reporter` writes one as a JSON line every few
+seconds for long running jobs.
+"""
+
+import functools
+import json
+import sys
+import threading
+import time
+from chess_env import Chessboard
+
+HOT_PATHS = [
+    "get_valid_moves",
+    "get_valid_codes",
+    "get_pawn_codes",
+    "get_slider_codes",
+    "get_fixed_codes",
+    "get_ctle_codes",
+    "make_move",
+    "undo_move",
+    "make_null_move",
+    "undo_null_move",
+]
+# methods returning a list of move codes, counted per piece type
+MOVE_LISTS = {
+    "get_pawn_codes",
+    "get_slider_codes",
+    "get_fixed_codes",
+    "get_ctle_codes",
+}
+
+
+class Profiler:
+    def __init__(self):
+        self.originals = {}  # method name -> unwrapped function while enabled
+        self.calls = dict.fromkeys(HOT_PATHS, 0)
+        self.seconds = dict.fromkeys(HOT_PATHS, 0.0)
+        self.moves = dict.fromkeys("PNBRQK", 0)
+
+    @property
+    def enabled(self):
+        return bool(self.originals)
+
+    def reset(self):  # in place, the wrappers keep writing to these dicts
+        for totals in [self.calls, self.seconds, self.moves]:
+            for key in totals:
+                totals[key] = 0
+
+    def enable(self):
+        if self.enabled:
+            return
+        for name in HOT_PATHS:
+            self.originals[name] = getattr(Chessboard, name)
+            setattr(Chessboard, name, self.wrap(name, self.originals[name]))
+
+    def disable(self):
+        for name, method in self.originals.items():
+            setattr(Chessboard, name, method)
+        self.originals = {}
+
+    def wrap(self, name, method):
+        calls, seconds, moves = self.calls, self.seconds, self.moves
+        clock = time.perf_counter
+        counts_moves = name in MOVE_LISTS
+
+        @functools.wraps(method)
+        def counted(*args, **kwargs):
+            start = clock()
+            result = method(*args, **kwargs)
+            seconds[name] += clock() - start
+            calls[name] += 1
+            if counts_moves:  # the pieces are still on their start squares
+                squares = args[0].squares
+                for code in result:
+                    moves[squares[code & 63].upper()] += 1
+            return result
+
+        return counted
+
+    def snapshot(self):  # plain dict, safe to pickle or dump as JSON
+        return {
+            "calls": dict(self.calls),
+            "seconds": dict(self.seconds),
+            "moves": dict(self.moves),
+        }
+
+    def merge(self, snapshot):  # adds the counts of another snapshot
+        for field, totals in [
+            ("calls", self.calls),
+            ("seconds", self.seconds),
+            ("moves", self.moves),
+        ]:
+            for key, value in snapshot[field].items():
+                totals[key] = totals.get(key, 0) + value
+
+
+class Reporter:
+    # writes a profiler snapshot as one JSON line every `every` seconds from
+    # a background thread, and once more when stopped
+    def __init__(self, profiler, every=10.0, stream=sys.stderr):
+        self.profiler = profiler
+        self.every = every
+        self.stream = stream
+        self.start_time = time.perf_counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def run(self):
+        while not self.stopped.wait(self.every):
+            self.report()
+
+    def report(self):
+        line = self.profiler.snapshot()
+        line["elapsed"] = time.perf_counter() - self.start_time
+        self.stream.write(json.dumps(line) + "\n")
+        self.stream.flush()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        self.report()
+
+
+PROFILER = Profiler()  # the one used by the command line --profile options
@@ -0,0 +1,261 @@
+"""
+This file is responsible to replay PGN files on several cores and write out
+one record per position.
+
+Input files are cut into byte-range shards (see pgn.read_games). Every shard
+is replayed by a worker process and written to its own tab-separated file,
+named after the shard number so the output order never depends on which
+worker finishes first. Finished shards are recorded in a checkpoint so an
+interrupted run picks up where it stopped.
+"""
+
+import contextlib
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from chess_error import ChessError
+from profiling import PROFILER, Profiler, Reporter
+import pgn
+
+RECORD_FIELDS = [
+    "game_offset",
+    "ply",
+    "board",
+    "side",
+    "castling",
+    "enpassant",
+    "move",
+    "result",
+]
+CHECKPOINT_FILE = "checkpoint.json"
+
+
+def make_shards(paths, shard_size):  # (path, start, stop) byte ranges
+    shards = []
+    for path in paths:
+        size = os.path.getsize(path)
+        for start in range(0, max(size, 1), shard_size):
+            shards.append((path, start, min(start + shard_size, size)))
+    return shards
+
+
+def shard_file(out_dir, index):
+    return os.path.join(out_dir, f"positions-{index:06d}.tsv")
+
+
+def position_record(g, game_offset, ply, m, result):
+    ep_col = g.hashed_enpassant_col()
+    return (
+        game_offset,
+        ply,
+        "".join(g.squares),
+        "w" if g.white_to_move else "b",
+        g.castling,
+        "-" if ep_col is None else ep_col,
+        m.uci,
+        result,
+    )
+
+
+def replay_shard(index, path, start, stop, out_path, profile=False):
+    # runs in a worker; with profile the stats carry this shard's hot paths
+    if profile:
+        PROFILER.reset()
+        PROFILER.enable()
+    games = positions = 0
+    tmp_path = out_path + ".tmp"
+    with open(tmp_path, "w") as out:
+        out.write("\t".join(RECORD_FIELDS) + "\n")
+        for game in pgn.read_games(
+            path, start=start, stop=stop, skip_invalid=True
+        ):
+            g = game.start_board()
+            for ply, m in enumerate(game.moves):
+                record = position_record(g, game.offset, ply, m, game.result)
+                out.write("\t".join(map(str, record)) + "\n")
+                g.make_move(m, validate=False)
+            games += 1
+            positions += len(game.moves)
+    os.replace(tmp_path, out_path)  # the shard only counts once complete
+    stats = {
+        "index": index,
+        "games": games,
+        "positions": positions,
+        "bytes": stop - start,
+    }
+    if profile:
+        stats["profile"] = PROFILER.snapshot()
+    return stats
+
+
+def load_checkpoint(out_dir, paths, shard_size):
+    checkpoint_path = os.path.join(out_dir, CHECKPOINT_FILE)
+    if not os.path.exists(checkpoint_path):
+        return {"paths": paths, "shard_size": shard_size, "done": {}}
+
+    with open(checkpoint_path) as f:
+        checkpoint = json.load(f)
+    if checkpoint["paths"] != paths or checkpoint["shard_size"] != shard_size:
+        raise ChessError(
+            f"{checkpoint_path} was written for other inputs or shard size"
+        )
+    # a shard whose output went missing is replayed again
+    checkpoint["done"] = {
+        index: stats
+        for index, stats in checkpoint["done"].items()
+        if os.path.exists(shard_file(out_dir, int(index)))
+    }
+    return checkpoint
+
+
+def save_checkpoint(out_dir, checkpoint):
+    checkpoint_path = os.path.join(out_dir, CHECKPOINT_FILE)
+    with open(checkpoint_path + ".tmp", "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(checkpoint_path + ".tmp", checkpoint_path)
+
+
+class Progress:
+    def __init__(self, total_shards, every=5.0, stream=sys.stderr):
+        self.total_shards = total_shards
+        self.every = every  # seconds between reports
+        self.stream = stream
+        self.shards = self.games = self.positions = self.bytes = 0
+        self.start = self.last_report = time.perf_counter()
+
+    def add(self, stats):
+        self.shards += 1
+        self.games += stats["games"]
+        self.positions += stats["positions"]
+        self.bytes += stats["bytes"]
+        now = time.perf_counter()
+        if now - self.last_report >= self.every:
+            self.last_report = now
+            self.report()
+
+    def summary(self):
+        seconds = time.perf_counter() - self.start
+        return {
+            "shards": self.shards,
+            "games": self.games,
+            "positions": self.positions,
+            "seconds": seconds,
+            "games_per_second": self.games / seconds if seconds else 0.0,
+            "positions_per_second": (
+                self.positions / seconds if seconds else 0.0
+            ),
+            "mb_per_second": self.bytes / 1e6 / seconds if seconds else 0.0,
+        }
+
+    def report(self):
+        s = self.summary()
+        print(
+            f"{s['shards']}/{self.total_shards} shards "
+            f"{s['games']} games {s['positions']} positions "
+            f"{s['positions_per_second']:.0f} positions/s "
+            f"{s['mb_per_second']:.2f} MB/s",
+            file=self.stream,
+        )
+
+
+def run(
+    paths,
+    out_dir,
+    workers=None,
+    shard_size=16 << 20,
+    max_in_flight=None,
+    profiler=None,
+):
+    # with a profiler, the hot path counts of every shard are merged into it
+    if shard_size <= 0:
+        raise ChessError(f"shard size must be positive, got {shard_size}")
+    os.makedirs(out_dir, exist_ok=True)
+    paths = [os.path.abspath(path) for path in paths]
+    checkpoint = load_checkpoint(out_dir, paths, shard_size)
+    shards = make_shards(paths, shard_size)
+    todo = deque(
+        (index, *shard)
+        for index, shard in enumerate(shards)
+        if str(index) not in checkpoint["done"]
+    )
+
+    workers = workers or os.cpu_count() or 1
+    max_in_flight = max_in_flight or 2 * workers
+    progress = Progress(len(todo))
+
+    with ProcessPoolExecutor(workers) as pool:
+        in_flight = set()
+        while todo or in_flight:
+            # keep at most max_in_flight shards queued or running
+            while todo and len(in_flight) < max_in_flight:
+                index, path, start, stop = todo.popleft()
+                in_flight.add(
+                    pool.submit(
+                        replay_shard,
+                        index,
+                        path,
+                        start,
+                        stop,
+                        shard_file(out_dir, index),
+                        profiler is not None,
+                    )
+                )
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                stats = future.result()
+                if profiler is not None:
+                    profiler.merge(stats.pop("profile"))
+                checkpoint["done"][str(stats["index"])] = stats
+                progress.add(stats)
+            save_checkpoint(out_dir, checkpoint)
+
+    progress.report()
+    return progress.summary()
+
+
+def add_command(commands):  # registers `python -m chess_env replay`
+    parser = commands.add_parser(
+        "replay", help="replay PGN files into per-position records"
+    )
+    parser.add_argument("pgn", nargs="+", help="PGN files to replay")
+    parser.add_argument("--out", required=True, help="output directory")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument(
+        "--shard-mb", type=float, default=16, help="megabytes of PGN per shard"
+    )
+    parser.add_argument(
+        "--max-in-flight",
+        type=int,
+        default=None,
+        help="shards queued or running at once, twice the workers by default",
+    )
+    parser.add_argument(
+        "--profile",
+        type=float,
+        default=None,
+        metavar="SECONDS",
+        help="report hot path counts as JSON lines every SECONDS on stderr",
+    )
+    parser.set_defaults(run=main)
+
+
+def main(args):
+    if args.profile is None:
+        profiler, reporter = None, contextlib.nullcontext()
+    else:
+        profiler = Profiler()  # totals of the workers, never enabled here
+        reporter = Reporter(profiler, every=args.profile)
+    with reporter:
+        summary = run(
+            args.pgn,
+            args.out,
+            workers=args.workers,
+            shard_size=int(args.shard_mb * (1 << 20)),
+            max_in_flight=args.max_in_flight,
+            profiler=profiler,
+        )
+    print(json.dumps(summary))
+    return 0
@@ -0,0 +1,446 @@
+"""
+This file is responsible to build and probe endgame tablebases of king and
+one piece against a bare king (KQK, KRK, KPK, ...).
+
+A table holds, for every position with the extra piece on white's side, the
+distance to mate in plies for the side to move, or a draw. The index is
+perfect, every position has its own slot: the 8 board symmetries bring the
+white king into the a1-d1-d4 triangle, or for pawns a mirror brings the pawn
+onto files a-d, and the other two pieces take 64 squares each. Slots that are
+no legal position are marked as such. Positions with the extra piece on
+black's side are probed through the colour-flipped board. The fifty move rule
+is not taken into account.
+
+The generator walks every position once with Chessboard's legal move
+generation, in several processes, which gives the moves out of each
+position. Inverted, these are the unmoves the retrograde analysis follows
+back from the mates, one ply at a time. Moves that leave the table (captures,
+promotions) are scored from the bare king draw or from an already built
+table.
+
+File layout, little-endian: a header (magic, table name, number of entries,
+bits per entry), then one code per entry packed into `bits` bits: 0 for no
+legal position, 1 for a draw, otherwise 2 + plies to mate. An odd number of
+plies is a win for the side to move, an even one a loss. The probe reads a
+single entry from the memory-mapped file.
+"""
+
+import mmap
+import os
+import struct
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from bitboard import KING_ATTACKS, SQUARE_BB, lsb
+from chess_env import Chessboard, START_FEN
+from chess_error import ChessError
+from move import FLAG_CAPTURE
+
+MAGIC = b"CHTBASE1"
+HEADER = struct.Struct("<8s4sQB")  # magic, name, entries, bits per entry
+
+TABLES = ["KQK", "KRK", "KBK", "KNK", "KPK"]
+DEFAULT_TABLES = ["KQK", "KRK", "KPK"]
+DEPENDS = {"KPK": ["KQK", "KRK"]}  # tables promotions lead into
+
+ILLEGAL, DRAW = 0, 1  # codes, 2 + plies otherwise
+
+
+def square(name):  # "a1" -> 56, board squares start at a8
+    return (8 - int(name[1])) * 8 + "abcdefgh".index(name[0])
+
+
+# the white king is brought into this triangle for tables without pawns
+TRIANGLE = [
+    square(name)
+    for name in ["a1", "b1", "c1", "d1", "b2", "c2", "d2", "c3", "d3", "d4"]
+]
+# and the pawn onto files a-d, ranks 2-7, for tables with one
+PAWN_SQUARES = [row * 8 + col for row in range(1, 7) for col in range(4)]
+
+
+def _symmetries():  # the 8 symmetries of the board, as square maps
+    maps = []
+    for diagonal in [False, True]:
+        for flip in range(4):
+            squares = []
+            for sq in range(64):
+                if diagonal:  # reflect in the a1-h8 diagonal
+                    sq = (7 - (sq & 7)) * 8 + 7 - (sq >> 3)
+                squares.append(
+                    sq ^ (7 if flip & 1 else 0) ^ (56 if flip & 2 else 0)
+                )
+            maps.append(squares)
+    return maps
+
+
+SYMMETRIES = _symmetries()
+# white king square -> the symmetry bringing it into the triangle
+KING_SYMMETRY = [
+    next(s for s in SYMMETRIES if s[sq] in TRIANGLE) for sq in range(64)
+]
+TRIANGLE_INDEX = {sq: i for i, sq in enumerate(TRIANGLE)}
+PAWN_INDEX = {sq: i for i, sq in enumerate(PAWN_SQUARES)}
+
+
+def table_size(name):
+    leaders = PAWN_SQUARES if name[1] == "P" else TRIANGLE
+    return len(leaders) * 64 * 64 * 2
+
+
+def position_index(name, wk, piece_sq, bk, white_to_move):
+    # slot of a position with the extra piece on white's side
+    if name[1] == "P":
+        if piece_sq & 7 > 3:  # mirror onto files a-d
+            wk, piece_sq, bk = wk ^ 7, piece_sq ^ 7, bk ^ 7
+        leader, a, b = PAWN_INDEX[piece_sq], wk, bk
+    else:
+        s = KING_SYMMETRY[wk]
+        leader, a, b = TRIANGLE_INDEX[s[wk]], s[piece_sq], s[bk]
+    return ((leader * 64 + a) * 64 + b) * 2 + (not white_to_move)
+
+
+def index_position(name, index):  # (wk, piece square, bk, white to move)
+    white_to_move = not index & 1
+    index >>= 1
+    b = index & 63
+    a = index >> 6 & 63
+    leader = index >> 12
+    if name[1] == "P":
+        return a, PAWN_SQUARES[leader], b, white_to_move
+    return TRIANGLE[leader], a, b, white_to_move
+
+
+def scan_positions(name, start, stop, directory):
+    # runs in a worker: plays every legal move of positions start..stop-1.
+    # returns their status, the moves staying in the table as (from, to)
+    # index pairs, and what the moves leaving it are worth
+    piece = name[1]
+    g = Chessboard()
+    g.castling = 0
+    tables = Tablebase(directory) if name in DEPENDS else None
+    count = stop - start
+    status = np.zeros(count, dtype=np.uint8)  # 0 illegal, 1 open, 2 final
+    final = np.full(count, DRAW, dtype=np.uint16)  # code when final
+    moves = np.zeros(count, dtype=np.int16)  # moves not known to lose
+    longest_loss = np.full(count, -1, dtype=np.int16)  # plies, moves out
+    fastest_win = np.full(count, -1, dtype=np.int16)  # plies, moves out
+    sources, targets = [], []
+
+    for i in range(count):
+        index = start + i
+        wk, piece_sq, bk, white_to_move = index_position(name, index)
+        if len({wk, piece_sq, bk}) < 3 or KING_ATTACKS[wk] & SQUARE_BB[bk]:
+            continue
+        squares = ["."] * 64
+        squares[wk], squares[piece_sq], squares[bk] = "K", piece, "k"
+        g.white_to_move = white_to_move
+        g.ep_sq = None
+        g.set_board([squares[row * 8 : row * 8 + 8] for row in range(8)])
+        occ = g.occupied[0] | g.occupied[1]
+        # the side that just moved can not have left its king in check
+        if g.attackers_to(bk if white_to_move else wk, occ, white_to_move):
+            continue
+
+        valid_moves = g.get_valid_moves()
+        if not valid_moves:  # mate is 0 plies away, stalemate is a draw
+            status[i] = 2
+            final[i] = 2 if g.in_check() else DRAW
+            continue
+        status[i] = 1
+        for m in valid_moves:
+            g.make_move(m, validate=False)
+            if m.code & FLAG_CAPTURE:  # only a bare king pair is left
+                moves[i] += 1
+            elif m.code >> 12 & 7:
+                result = tables.probe(g) if m.promote_to in "QR" else None
+                if result is None or result[0] == 0:
+                    moves[i] += 1  # draws, with a bishop or knight too
+                elif result[0] < 0:  # mated side is the one to move there
+                    moves[i] += 1
+                    if fastest_win[i] < 0 or result[1] < fastest_win[i]:
+                        fastest_win[i] = result[1]
+                else:
+                    longest_loss[i] = max(longest_loss[i], result[1])
+            else:
+                bb = g.bitboards
+                sources.append(index)
+                targets.append(
+                    position_index(
+                        name,
+                        lsb(bb["K"]),
+                        lsb(bb[piece]),
+                        lsb(bb["k"]),
+                        g.white_to_move,
+                    )
+                )
+                moves[i] += 1
+            g.undo_move()
+
+    if tables is not None:
+        tables.close()
+    return (
+        start,
+        status,
+        final,
+        moves,
+        longest_loss,
+        fastest_win,
+        np.array(sources, dtype=np.int64),
+        np.array(targets, dtype=np.int64),
+    )
+
+
+def retrograde(size, scans):
+    # plies to mate of every position, from the scans of all chunks: mates
+    # first, then every position whose value follows from the ones before
+    status = np.zeros(size, dtype=np.uint8)
+    final = np.zeros(size, dtype=np.uint16)
+    moves = np.zeros(size, dtype=np.int16)
+    longest_loss = np.zeros(size, dtype=np.int16)
+    fastest_win = np.zeros(size, dtype=np.int16)
+    sources, targets = [], []
+    for scan in scans:
+        start, *arrays, scan_sources, scan_targets = scan
+        stop = start + len(arrays[0])
+        for whole, part in zip(
+            [status, final, moves, longest_loss, fastest_win], arrays
+        ):
+            whole[start:stop] = part
+        sources.append(scan_sources)
+        targets.append(scan_targets)
+
+    # unmoves: the positions a move leads from, grouped by the one it leads to
+    sources = np.concatenate(sources)
+    targets = np.concatenate(targets)
+    order = np.argsort(targets, kind="stable")
+    parents = sources[order].tolist()
+    bounds = np.searchsorted(targets[order], np.arange(size + 1)).tolist()
+
+    plies = [-1] * size
+    layers = {}  # plies -> positions that may be decided at that distance
+    codes = np.where(status == 2, final, ILLEGAL).astype(np.uint16)
+    codes[status == 1] = DRAW  # until shown otherwise
+    for i in np.flatnonzero((status == 2) & (final == 2)).tolist():
+        layers.setdefault(0, []).append(i)
+    for i in np.flatnonzero((status == 1) & (fastest_win >= 0)).tolist():
+        layers.setdefault(int(fastest_win[i]) + 1, []).append(i)
+    for i in np.flatnonzero((status == 1) & (moves == 0)).tolist():
+        # every move leaves the table into a lost position
+        layers.setdefault(int(longest_loss[i]) + 1, []).append(i)
+
+    moves = moves.tolist()
+    longest_loss = longest_loss.tolist()
+    n = 0
+    while layers:
+        for i in layers.pop(n, []):
+            if plies[i] >= 0:  # decided at a shorter distance already
+                continue
+            plies[i] = n
+            for parent in parents[bounds[i] : bounds[i + 1]]:
+                if plies[parent] >= 0:
+                    continue
+                if n % 2 == 0:  # i is lost, so moving there wins
+                    layers.setdefault(n + 1, []).append(parent)
+                    continue
+                # i is won, the parent loses only if all its moves do
+                moves[parent] -= 1
+                longest_loss[parent] = max(longest_loss[parent], n)
+                if moves[parent] == 0:
+                    layers.setdefault(longest_loss[parent] + 1, []).append(
+                        parent
+                    )
+        n += 1
+
+    plies = np.array(plies, dtype=np.int64)
+    decided = plies >= 0
+    codes[decided] = plies[decided] + 2
+    return codes
+
+
+def write_table(path, name, codes):
+    bits = max(int(codes.max()).bit_length(), 1)
+    planes = (codes[:, None] >> np.arange(bits, dtype=np.uint16)) & 1
+    packed = np.packbits(planes.astype(np.uint8).ravel(), bitorder="little")
+    with open(path + ".tmp", "wb") as f:
+        f.write(HEADER.pack(MAGIC, name.encode(), len(codes), bits))
+        f.write(packed.tobytes())
+        f.write(bytes(3))  # a probe always reads three bytes
+    os.replace(path + ".tmp", path)
+
+
+def build_table(name, directory, workers=None, chunk_size=4096):
+    # writes <directory>/<name>.tb; returns a dict of statistics
+    if name not in TABLES:
+        raise ChessError(f"unknown table {name!r}, known are {TABLES}")
+    for dependency in DEPENDS.get(name, []):
+        if not os.path.exists(table_path(directory, dependency)):
+            raise ChessError(f"{name} needs {dependency} to be built first")
+    begin = time.perf_counter()
+    size = table_size(name)
+    starts = range(0, size, chunk_size)
+    with ProcessPoolExecutor(workers or os.cpu_count() or 1) as pool:
+        scans = list(
+            pool.map(
+                scan_positions,
+                [name] * len(starts),
+                starts,
+                [min(start + chunk_size, size) for start in starts],
+                [directory] * len(starts),
+            )
+        )
+    codes = retrograde(size, scans)
+    path = table_path(directory, name)
+    write_table(path, name, codes)
+
+    plies = codes.astype(np.int64) - 2
+    legal = codes != ILLEGAL
+    return {
+        "table": name,
+        "positions": int(legal.sum()),
+        "wins": int((legal & (plies >= 0) & (plies % 2 == 1)).sum()),
+        "draws": int((codes == DRAW).sum()),
+        "losses": int((legal & (plies >= 0) & (plies % 2 == 0)).sum()),
+        "longest_mate": int(plies.max()),
+        "bytes": os.path.getsize(path),
+        "seconds": time.perf_counter() - begin,
+    }
+
+
+def table_path(directory, name):
+    return os.path.join(directory, name + ".tb")
+
+
+class Table:  # one memory-mapped table file
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        try:
+            self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty file
+            self.file.close()
+            raise ChessError(f"{path} is not a tablebase")
+        magic, name, self.size, self.bits = HEADER.unpack_from(self.mm, 0)
+        self.name = name.rstrip(b"\0").decode()
+        if (
+            magic != MAGIC
+            or self.size != table_size(self.name)
+            or len(self.mm)
+            != HEADER.size + (self.size * self.bits + 7) // 8 + 3
+        ):
+            self.close()
+            raise ChessError(f"{path} is not a tablebase")
+        self.mask = (1 << self.bits) - 1
+
+    def __getitem__(self, index):  # code of a slot
+        bit = index * self.bits
+        start = HEADER.size + (bit >> 3)
+        word = int.from_bytes(self.mm[start : start + 3], "little")
+        return word >> (bit & 7) & self.mask
+
+    def close(self):
+        self.mm.close()
+        self.file.close()
+
+
+class Tablebase:  # every table found in a directory
+    def __init__(self, directory):
+        self.tables = {}
+        for name in TABLES:
+            path = table_path(directory, name)
+            if os.path.exists(path):
+                self.tables[name] = Table(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        for table in self.tables.values():
+            table.close()
+        self.tables = {}
+
+    def probe(self, g: Chessboard):
+        # (wdl, plies to mate) for the side to move, wdl 1 win, 0 draw, -1
+        # loss, plies None for a draw; None if no table has the position
+        if g.castling:  # the tables are built without castling rights
+            return None
+        counts = g.piece_counts
+        extra = [piece for piece in "QRBNPqrbnp" if counts[piece]]
+        if (
+            len(extra) != 1
+            or counts[extra[0]] != 1
+            or counts["K"] != 1
+            or counts["k"] != 1
+        ):
+            return None
+        piece = extra[0]
+        bb = g.bitboards
+        wk, piece_sq, bk = lsb(bb["K"]), lsb(bb[piece]), lsb(bb["k"])
+        white_to_move = g.white_to_move
+        if piece.islower():  # look at the board with the colours swapped
+            wk, piece_sq, bk = bk ^ 56, piece_sq ^ 56, wk ^ 56
+            white_to_move = not white_to_move
+        name = "K" + piece.upper() + "K"
+        table = self.tables.get(name)
+        if table is None:
+            return None
+        code = table[position_index(name, wk, piece_sq, bk, white_to_move)]
+        if code == ILLEGAL:  # e.g. the side not to move is in check
+            return None
+        if code == DRAW:
+            return 0, None
+        plies = code - 2
+        return (1 if plies % 2 else -1), plies
+
+
+def add_command(commands):  # registers `python -m chess_env tablebase`
+    parser = commands.add_parser(
+        "tablebase", help="build or probe endgame tablebases"
+    )
+    actions = parser.add_subparsers(dest="action", required=True)
+
+    build = actions.add_parser("build", help="generate tables")
+    build.add_argument(
+        "tables",
+        nargs="*",
+        default=DEFAULT_TABLES,
+        help=f"tables to build, in order, from {' '.join(TABLES)}",
+    )
+    build.add_argument("--out", required=True, help="directory of tables")
+    build.add_argument("--workers", type=int, default=None)
+    build.set_defaults(run=main_build)
+
+    probe = actions.add_parser("probe", help="look up a FEN")
+    probe.add_argument("directory", help="directory of tables")
+    probe.add_argument("--fen", default=START_FEN)
+    probe.set_defaults(run=main_probe)
+
+
+def main_build(args):
+    os.makedirs(args.out, exist_ok=True)
+    for name in args.tables:
+        stats = build_table(name, args.out, args.workers)
+        print(
+            f"{name}: {stats['positions']} positions, {stats['wins']} wins "
+            f"{stats['draws']} draws {stats['losses']} losses, longest mate "
+            f"{stats['longest_mate']} plies, {stats['bytes']} bytes in "
+            f"{stats['seconds']:.1f}s",
+            file=sys.stderr,
+        )
+    return 0
+
+
+def main_probe(args):
+    with Tablebase(args.directory) as tables:
+        result = tables.probe(Chessboard.from_fen(args.fen))
+    if result is None:
+        print("not in the tablebase")
+    elif result[0] == 0:
+        print("draw")
+    else:
+        wdl, plies = result
+        print(f"{'win' if wdl > 0 else 'loss'} mate in {plies} plies")
+    return 0
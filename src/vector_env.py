@@ -0,0 +1,136 @@
+"""
+This file is responsible to step many games at once for self-play and
+reinforcement learning.
+
+`VectorEnv` holds N boards and exposes them as stacked NumPy arrays: the
+planes of encoding.BoardEncoder plus a legal action mask. An action is the
+start, end and promotion part of a move code (`code & MOVE_MASK`), so there
+are ACTION_SIZE of them and a move code maps to its action with one `&`.
+Rewards are for the side that made the move: 1 for a mate, 0 otherwise.
+Finished games are reset straight away, their outcome is reported in `info`.
+
+Move generation and make_move still run per board; everything around them
+(observations, masks, action checks, rewards) is done for the whole batch
+with array operations on preallocated buffers.
+"""
+
+import numpy as np
+from chess_env import Chessboard, START_FEN
+from chess_error import ChessError
+from encoding import BoardEncoder
+from move import MOVE_MASK
+
+ACTION_SIZE = MOVE_MASK + 1
+
+
+class VectorEnv:
+    def __init__(self, n, fen=START_FEN, max_plies=None, dtype=np.float32):
+        self.n = n
+        self.fen = fen
+        self.max_plies = max_plies  # games longer than this are truncated
+        self.encoder = BoardEncoder(n, dtype)
+        self.legal = np.zeros((n, ACTION_SIZE), dtype=bool)
+        self.rewards = np.zeros(n, dtype=np.float32)
+        self.terminated = np.zeros(n, dtype=bool)
+        self.truncated = np.zeros(n, dtype=bool)
+        self.boards = [None] * n
+        self.moves = [{}] * n  # action -> Move, the legal moves of each board
+
+    def reset(self):  # every board back to the start, returns observations
+        for i in range(self.n):
+            self.boards[i] = Chessboard.from_fen(self.fen)
+        self.legal[:] = False
+        self.update_moves(range(self.n))
+        return self.observe()
+
+    def observe(self):
+        planes, side, castling = self.encoder.encode(self.boards)
+        return {
+            "planes": planes,
+            "side": side,
+            "castling": castling,
+            "legal": self.legal,
+        }
+
+    def update_moves(self, indices):
+        # regenerates the legal moves of the given boards and their masks
+        rows, old, new = [], [], []
+        for i in indices:
+            old.append(np.fromiter(self.moves[i], dtype=np.int64))
+            moves = {
+                m.code & MOVE_MASK: m for m in self.boards[i].get_valid_moves()
+            }
+            self.moves[i] = moves
+            new.append(np.fromiter(moves, dtype=np.int64, count=len(moves)))
+            rows.append(i)
+        if not rows:
+            return
+        rows = np.array(rows)
+        old_rows = np.repeat(rows, [len(a) for a in old])
+        self.legal[old_rows, np.concatenate(old)] = False
+        new_rows = np.repeat(rows, [len(a) for a in new])
+        self.legal[new_rows, np.concatenate(new)] = True
+
+    def step(self, actions):
+        # plays one action on every board; returns observations, rewards,
+        # terminated, truncated and info, like a gymnasium vector env
+        actions = np.asarray(actions, dtype=np.int64)
+        if actions.shape != (self.n,):
+            raise ChessError(f"expected {self.n} actions, got {actions.shape}")
+        in_range = (actions >= 0) & (actions < ACTION_SIZE)
+        ok = in_range.copy()
+        ok[in_range] = self.legal[np.flatnonzero(in_range), actions[in_range]]
+        if not ok.all():
+            bad = np.flatnonzero(~ok)
+            raise ChessError(f"illegal actions on boards {bad.tolist()}")
+
+        self.rewards[:] = 0
+        self.terminated[:] = False
+        self.truncated[:] = False
+        results = [None] * self.n
+        for i, action in enumerate(actions.tolist()):
+            g = self.boards[i]
+            g.make_move(self.moves[i][action], validate=False)
+
+        self.update_moves(range(self.n))
+
+        finished = []
+        for i, g in enumerate(self.boards):
+            reason = g.game_over_reason(self.moves[i])
+            if reason is not None:
+                self.terminated[i] = True
+                results[i] = reason
+                if reason == "checkmate":
+                    self.rewards[i] = 1.0
+            elif (
+                self.max_plies is not None and g.n_half_moves >= self.max_plies
+            ):
+                self.truncated[i] = True
+                results[i] = "max_plies"
+            if results[i] is not None:
+                finished.append(i)
+
+        info = {"result": results, "final_fen": [None] * self.n}
+        for i in finished:  # auto-reset
+            info["final_fen"][i] = self.boards[i].to_fen()
+            self.boards[i] = Chessboard.from_fen(self.fen)
+        self.update_moves(finished)
+
+        return (
+            self.observe(),
+            self.rewards,
+            self.terminated,
+            self.truncated,
+            info,
+        )
+
+    def sample_actions(self, rng=None):  # a random legal action per board
+        rng = rng or np.random.default_rng()
+        picks = rng.random(self.n)
+        return np.array(
+            [
+                list(moves)[int(pick * len(moves))]
+                for moves, pick in zip(self.moves, picks)
+            ],
+            dtype=np.int64,
+        )
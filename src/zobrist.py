@@ -0,0 +1,35 @@
+"""
+This file is responsible to hold the random keys used for Zobrist hashing.
+
+A position key is the XOR of one key per (piece, square), one for black to
+move, one per castling rights combination and one per en passant column, so
+a move only has to XOR in what changed.
+"""
+
+import random
+
+_rng = random.Random(0x5EED)  # fixed seed, keys are stable across runs
+
+
+def _key():
+    return _rng.getrandbits(64)
+
+
+PIECE_KEYS = {piece: [_key() for _ in range(64)] for piece in "PNBRQKpnbrqk"}
+BLACK_TO_MOVE_KEY = _key()
+# indexed by the 4-bit mask from Chessboard.castling
+CASTLING_KEYS = [0] + [_key() for _ in range(15)]
+ENPASSANT_KEYS = [_key() for _ in range(8)]  # per column
+
+
+def position_key(squares, white_to_move, castling_rights, enpassant_col):
+    key = 0
+    for sq, piece in enumerate(squares):
+        if piece != ".":
+            key ^= PIECE_KEYS[piece][sq]
+    if not white_to_move:
+        key ^= BLACK_TO_MOVE_KEY
+    key ^= CASTLING_KEYS[castling_rights]
+    if enpassant_col is not None:
+        key ^= ENPASSANT_KEYS[enpassant_col]
+    return key